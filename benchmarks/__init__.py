@@ -0,0 +1,5 @@
+"""
+Micro-benchmarks for the tapystry event loop.
+
+Run with `python -m benchmarks`, see `python -m benchmarks --help`.
+"""
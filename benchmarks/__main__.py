@@ -0,0 +1,22 @@
+import argparse
+
+from benchmarks import harness
+from benchmarks import bench_core, bench_memory, bench_threads  # noqa: F401
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run tapystry micro-benchmarks")
+    parser.add_argument("filter", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every benchmark size by this")
+    parser.add_argument("--json", dest="json_path", help="write results to this file as JSON")
+    args = parser.parse_args()
+
+    report = harness.run_benchmarks(names=args.filter, repeat=args.repeat, scale=args.scale)
+    print(harness.format_results(report))
+    if args.json_path:
+        harness.dump_json(report, args.json_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Throughput of the core effects in tapystry.run
+"""
+import tapystry as tap
+
+from benchmarks.harness import benchmark
+
+
+@benchmark("broadcast_receive_pingpong", n=20000)
+def broadcast_receive_pingpong(n):
+    def ponger():
+        for _ in range(n):
+            yield tap.Receive("ping")
+            yield tap.Broadcast("pong")
+
+    def fn():
+        yield tap.CallFork(ponger)
+        for _ in range(n):
+            yield tap.Broadcast("ping")
+            yield tap.Receive("pong")
+
+    tap.run(fn)
+    return 4 * n + 1
+
+
+def _deep_call_chain(n, inline_calls):
+    def recurse(depth):
+        if depth == 0:
+            yield tap.Broadcast("bottom")
+            return 0
+        result = yield tap.Call(recurse, (depth - 1,))
+        return result + 1
+
+    def fn():
+        total = 0
+        for _ in range(20):
+            total += yield tap.Call(recurse, (n,))
+        return total
+
+    assert tap.run(fn, inline_calls=inline_calls) == 20 * n
+    return 20 * (n + 2)
+
+
+@benchmark("deep_call_chain", n=100)
+def deep_call_chain(n):
+    return _deep_call_chain(n, inline_calls=False)
+
+
+@benchmark("deep_call_chain_inline", n=100)
+def deep_call_chain_inline(n):
+    return _deep_call_chain(n, inline_calls=True)
+
+
+@benchmark("call_immediate_helpers", n=20000)
+def call_immediate_helpers(n):
+    cache = dict()
+
+    @tap.as_effect()
+    def lookup(key):
+        # usually returns without yielding anything
+        if key not in cache:
+            yield tap.Broadcast("miss")
+            cache[key] = key
+        return cache[key]
+
+    def increment(x):
+        return x + 1
+
+    def fn():
+        total = 0
+        for i in range(n):
+            total += yield lookup(i % 100)
+            total = yield tap.Call(increment, (total,))
+        return total
+
+    tap.run(fn)
+    return 2 * n + 100
+
+
+@benchmark("wide_callfork_fanout", n=10000)
+def wide_callfork_fanout(n):
+    def child(i):
+        yield tap.Broadcast("child")
+        return i
+
+    def fn():
+        strands = []
+        for i in range(n):
+            strands.append((yield tap.CallFork(child, (i,))))
+        for strand in strands:
+            yield tap.Join(strand)
+
+    tap.run(fn)
+    return 3 * n
+
+
+@benchmark("fork_scatter_gather", n=10000)
+def fork_scatter_gather(n):
+    def work(i):
+        yield tap.Broadcast("work")
+        return i
+
+    def fn():
+        strands = yield tap.Fork([tap.Call(work, (i,)) for i in range(n)])
+        results = yield tap.Join(strands)
+        assert results == list(range(n))
+
+    tap.run(fn)
+    return 3 * n + 2
+
+
+@benchmark("map_bounded_concurrency", n=10000)
+def map_bounded_concurrency(n):
+    def work(i):
+        yield tap.Broadcast("work")
+        return i
+
+    def fn():
+        results = yield tap.Map(work, range(n), concurrency=64)
+        assert results == list(range(n))
+
+    tap.run(fn)
+    return 3 * n + 2
+
+
+@benchmark("race_over_strands", n=200)
+def race_over_strands(n):
+    def fn():
+        for i in range(20):
+            effects = [tap.Receive(f"race.{j}") for j in range(n)]
+            t = yield tap.Fork(tap.Race(effects))
+            yield tap.Broadcast(f"race.{i % n}")
+            yield tap.Join(t)
+
+    tap.run(fn)
+    return 20 * (n + 3)
+
+
+@benchmark("race_pairs", n=5000)
+def race_pairs(n):
+    def fn():
+        for i in range(n):
+            t = yield tap.Fork(tap.Race(dict(
+                value=tap.Receive("value"),
+                stop=tap.Receive("stop"),
+            )))
+            yield tap.Broadcast("value", i)
+            assert (yield tap.Join(t)) == ("value", i)
+
+    tap.run(fn)
+    return 5 * n
+
+
+@benchmark("race_wide", n=1000)
+def race_wide(n):
+    def fn():
+        for i in range(5):
+            t = yield tap.Fork(tap.Race([tap.Receive(f"race.{j}") for j in range(n)]))
+            yield tap.Broadcast(f"race.{(n - 1 - i) % n}")
+            yield tap.Join(t)
+
+    tap.run(fn)
+    return 5 * (n + 3)
+
+
+@benchmark("join_over_strands", n=5000)
+def join_over_strands(n):
+    def child(i):
+        yield tap.Receive("go")
+        return i
+
+    def fn():
+        strands = []
+        for i in range(n):
+            strands.append((yield tap.CallFork(child, (i,))))
+        yield tap.Broadcast("go")
+        results = yield tap.Join(strands)
+        assert results == list(range(n))
+
+    tap.run(fn)
+    return 4 * n + 2
+
+
+def _lock_contention(n, inline_calls):
+    lock = tap.Lock()
+    workers = 20
+
+    def worker():
+        for _ in range(n // workers):
+            release = yield lock.Acquire()
+            yield tap.Broadcast("work")
+            yield release
+
+    def fn():
+        strands = []
+        for _ in range(workers):
+            strands.append((yield tap.CallFork(worker)))
+        yield tap.Join(strands)
+
+    tap.run(fn, inline_calls=inline_calls)
+    return 3 * (n // workers) * workers
+
+
+@benchmark("lock_contention", n=2000)
+def lock_contention(n):
+    return _lock_contention(n, inline_calls=False)
+
+
+@benchmark("lock_contention_inline", n=2000)
+def lock_contention_inline(n):
+    return _lock_contention(n, inline_calls=True)
+
+
+@benchmark("queue_producer_consumer", n=10000)
+def queue_producer_consumer(n):
+    q = tap.Queue(buffer_size=16)
+
+    def producer():
+        for i in range(n):
+            yield q.Put(i)
+
+    def consumer():
+        total = 0
+        for _ in range(n):
+            total += yield q.Get()
+        return total
+
+    def fn():
+        p = yield tap.CallFork(producer)
+        c = yield tap.CallFork(consumer)
+        yield tap.Join(p)
+        return (yield tap.Join(c))
+
+    assert tap.run(fn) == n * (n - 1) // 2
+    return 2 * n
+
+
+def _many_waiters(n, receive):
+    def receiver(i):
+        yield receive(i)
+
+    def fn():
+        for i in range(n):
+            yield tap.CallFork(receiver, (i,))
+        yield tap.Sleep(0)
+        for i in range(n):
+            yield tap.Broadcast("msg", dict(id=i))
+
+    tap.run(fn)
+    return 3 * n + 1
+
+
+@benchmark("receive_many_waiters_predicate", n=2000)
+def receive_many_waiters_predicate(n):
+    return _many_waiters(n, lambda i: tap.Receive("msg", lambda v: v["id"] == i))
+
+
+@benchmark("receive_many_waiters_match", n=2000)
+def receive_many_waiters_match(n):
+    return _many_waiters(n, lambda i: tap.Receive("msg", match={"id": i}))
@@ -0,0 +1,22 @@
+"""
+Memory held by the engine for strands that are parked waiting on an effect
+"""
+import tapystry as tap
+
+from benchmarks.harness import memory_benchmark
+
+
+@memory_benchmark("parked_receive_strand", n=50000)
+def parked_receive_strand(n, measure):
+    def receiver():
+        yield tap.Receive("wake")
+
+    def fn():
+        for _ in range(n):
+            yield tap.CallFork(receiver)
+        # let every receiver park on its Receive
+        yield tap.Sleep(0)
+        measure()
+        yield tap.Broadcast("wake")
+
+    tap.run(fn)
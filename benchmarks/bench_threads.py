@@ -0,0 +1,40 @@
+"""
+Throughput and latency of CallThread completions
+"""
+import time
+
+import tapystry as tap
+
+from benchmarks.harness import benchmark
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+@benchmark("short_callthread_burst", n=10000)
+def short_callthread_burst(n):
+    latencies = []
+
+    def finished():
+        return time.perf_counter()
+
+    def worker():
+        done_at = yield tap.CallThread(finished)
+        # time from the thread finishing to the strand being resumed
+        latencies.append(time.perf_counter() - done_at)
+
+    def fn():
+        strands = []
+        for _ in range(n):
+            strands.append((yield tap.CallFork(worker)))
+        for strand in strands:
+            yield tap.Join(strand)
+
+    tap.run(fn, max_threads=8)
+    assert len(latencies) == n
+    return 3 * n, dict(
+        p50_latency_ms=_percentile(latencies, 0.5) * 1000,
+        p99_latency_ms=_percentile(latencies, 0.99) * 1000,
+    )
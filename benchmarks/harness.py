@@ -0,0 +1,138 @@
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import tapystry
+
+
+_benchmarks = dict()
+_memory_benchmarks = dict()
+
+
+def benchmark(name, n):
+    """
+    Registers a benchmark.
+    The decorated function takes a size n, and returns the number of effects it yielded to the engine,
+    optionally along with a dict of extra metrics (e.g. latencies) to report for the fastest run.
+    """
+    def decorator(f):
+        if name in _benchmarks:
+            raise ValueError(f"Duplicate benchmark {name}")
+        _benchmarks[name] = (f, n)
+        return f
+    return decorator
+
+
+def memory_benchmark(name, n):
+    """
+    Registers a memory benchmark.
+    The decorated function takes a size n and a measure() callback, which it should call once n items are live.
+    Reports bytes allocated per item at the point measure() was called.
+    """
+    def decorator(f):
+        if name in _memory_benchmarks:
+            raise ValueError(f"Duplicate memory benchmark {name}")
+        _memory_benchmarks[name] = (f, n)
+        return f
+    return decorator
+
+
+def _measure_memory(f, n):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        measured = []
+
+        def measure():
+            gc.collect()
+            measured.append(tracemalloc.get_traced_memory()[0] - baseline)
+
+        f(n, measure)
+    finally:
+        tracemalloc.stop()
+    assert len(measured) == 1, "memory benchmarks should call measure() exactly once"
+    return measured[0]
+
+
+def _time_once(f, n):
+    gc.collect()
+    start = time.perf_counter()
+    effects = f(n)
+    elapsed = time.perf_counter() - start
+    extra = dict()
+    if isinstance(effects, tuple):
+        effects, extra = effects
+    return elapsed, effects, extra
+
+
+def run_benchmarks(names=None, repeat=5, scale=1.0):
+    results = []
+    for name, (f, n) in _benchmarks.items():
+        if names and not any(x in name for x in names):
+            continue
+        n = max(1, int(n * scale))
+        timings = []
+        effects = None
+        best_extra = None
+        for _ in range(repeat):
+            elapsed, effects, extra = _time_once(f, n)
+            if not timings or elapsed < min(timings):
+                best_extra = extra
+            timings.append(elapsed)
+        best = min(timings)
+        results.append(dict(
+            name=name,
+            n=n,
+            effects=effects,
+            repeat=repeat,
+            best_seconds=best,
+            mean_seconds=sum(timings) / len(timings),
+            effects_per_second=effects / best if best > 0 else None,
+            **best_extra,
+        ))
+    memory = []
+    for name, (f, n) in _memory_benchmarks.items():
+        if names and not any(x in name for x in names):
+            continue
+        n = max(1, int(n * scale))
+        total = _measure_memory(f, n)
+        memory.append(dict(
+            name=name,
+            n=n,
+            bytes=total,
+            bytes_per_item=total / n,
+        ))
+    return dict(
+        tapystry_version=getattr(tapystry, "__version__", None),
+        python=sys.version,
+        platform=platform.platform(),
+        results=results,
+        memory=memory,
+    )
+
+
+_RESULT_KEYS = {"name", "n", "effects", "repeat", "best_seconds", "mean_seconds", "effects_per_second"}
+
+
+def format_results(report):
+    lines = []
+    for r in report["results"]:
+        line = f"{r['name']:<32} n={r['n']:<8} {r['best_seconds'] * 1000:10.2f} ms  {r['effects_per_second']:14,.0f} effects/s"
+        extra = [k for k in r if k not in _RESULT_KEYS]
+        if extra:
+            line += "  " + "  ".join(f"{k}={r[k]:.3g}" for k in extra)
+        lines.append(line)
+    for r in report["memory"]:
+        lines.append(
+            f"{r['name']:<32} n={r['n']:<8} {r['bytes'] / 1e6:10.2f} MB  {r['bytes_per_item']:14,.0f} bytes/item"
+        )
+    return "\n".join(lines)
+
+
+def dump_json(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
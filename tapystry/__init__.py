@@ -1,6 +1,6 @@
-from .main import run, Effect, Strand, TapystryError
+from .main import run, run_async, Engine, Effect, Strand, TapystryError, register_handler
 
-from .main import Broadcast, Receive, CallFork, First, Call, Cancel, CallThread, Intercept, DebugTree, Wrapper
+from .main import Broadcast, Receive, CallFork, ForkMany, First, Race, JoinAll, Call, Cancel, CallThread, ThreadContext, CallProcess, Await, Sleep, Timeout, Intercept, DebugTree, Wrapper
 from .utils import as_effect, runnable
-from .effects import Sequence, Fork, Join, Race, Subscribe, Sleep
+from .effects import Sequence, Fork, Join, Subscribe, Map
 from .concurrency import Lock, Queue, debounced, with_lock
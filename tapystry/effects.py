@@ -1,6 +1,7 @@
-import time
-
-from tapystry import Effect, Strand, Call, Broadcast, Receive, CallFork, First, Cancel, TapystryError, CallThread, Wrapper
+from tapystry import (
+    Effect, Strand, Call, Broadcast, Receive, CallFork, ForkMany, First, JoinAll, Cancel, TapystryError, Wrapper,
+)
+from tapystry import Race, Sleep  # noqa: F401 (now native to the engine, kept importable from here)
 from tapystry import as_effect
 
 
@@ -44,60 +45,124 @@ def Join(strands, name=None):
         key, val = yield First([strands], name=f"Join({name})")
         assert key == 0
         return val
-    elif isinstance(strands, list):
-        vals = yield Sequence([Join(v, name=name) for v in strands])
-        return vals
     else:
-        if not isinstance(strands, dict):
-            raise TapystryError(f"Input to Join should be a Strand (or nested list/dict of them): {strands}")
-        vals = yield Sequence({k: Join(v, name=name) for k, v in strands.items()})
-        return vals
+        # wait for all of them at once, then put the results back in shape
+        flat = []
+        _flatten(strands, flat, "Join", Strand)
+        vals = iter((yield JoinAll(flat, name=name)))
+        return _unflatten(strands, vals, Strand)
+
+
+def _flatten(structure, flat, name, leaf_type):
+    if isinstance(structure, leaf_type):
+        flat.append(structure)
+    elif isinstance(structure, list):
+        for v in structure:
+            _flatten(v, flat, name, leaf_type)
+    else:
+        if not isinstance(structure, dict):
+            article = "an" if leaf_type.__name__[0] in "AEIOU" else "a"
+            raise TapystryError(
+                f"Input to {name} should be {article} {leaf_type.__name__} (or nested list/dict of them): {structure}"
+            )
+        for v in structure.values():
+            _flatten(v, flat, name, leaf_type)
+
+
+def _unflatten(structure, vals, leaf_type):
+    if isinstance(structure, leaf_type):
+        return next(vals)
+    elif isinstance(structure, list):
+        return [_unflatten(v, vals, leaf_type) for v in structure]
+    else:
+        return {k: _unflatten(v, vals, leaf_type) for k, v in structure.items()}
 
 
 def Fork(effects, *, run_first=False):
     """Do each of the effects in parallel.
-    Returns a strand, whose result reflects the same structure as the effects passed in
+    Returns a strand (or a nested structure of strands, with the same structure as the effects passed in)
     """
+    if isinstance(effects, Effect):
+        return Wrapper(CallFork(_call_fork, (effects,), run_first=run_first), type="Fork")
+    # fork all of them in one step
+    flat = []
+    _flatten(effects, flat, "Fork", Effect)
+    return Wrapper(Call(_fork_many, (effects, flat, run_first)), type="Fork")
 
-    def call_fork(effect):
-        val = yield effect
-        return val
 
-    def fork_effects(effects):
-        if isinstance(effects, Effect):
-            return CallFork(call_fork, (effects,), run_first=run_first)
-        elif isinstance(effects, list):
-            return [fork_effects(v) for v in effects]
-        else:
-            if not isinstance(effects, dict):
-                raise TapystryError(f"Input to Fork should be an Effect (or nested list/dict of them): {effects}")
-            return {k: fork_effects(v) for k, v in effects.items()}
+def _call_fork(effect):
+    val = yield effect
+    return val
+
 
-    return Wrapper(Sequence(fork_effects(effects)), type="Fork")
+def _fork_many(effects, flat, run_first):
+    strands = yield ForkMany(flat, run_first=run_first)
+    return _unflatten(effects, iter(strands), Effect)
 
 
-@as_effect("Race")
-def Race(effects, name=None, ensure_cancel=True):
-    """Wait for the first of the effects to finish.
-    Returns a tuple with the key of the winning item, and its value
+@as_effect("Map")
+def Map(fn, items, concurrency=None, ordered=True, on_result=None):
     """
-    if isinstance(effects, list):
-        keys = list(range(len(effects)))
-        effects_array = effects
-    else:
-        if not isinstance(effects, dict):
-            raise TapystryError(f"Input to Race should be an Effect (or nested list/dict of them): {effects}")
-        keys, effects_array = zip(*effects.items())
-    strands = []
-    for key, effect in zip(keys, effects_array):
-        strand = yield Fork(effect)
-        strands.append(strand)
-    i, result = yield First(strands, name=f"Race({name})", ensure_cancel=ensure_cancel)
-    return keys[i], result
+    Calls fn (a generator function, or a normal one) on each of the items, with at most concurrency calls running at a time.
+    Items can be any iterable, and are only taken from it as calls start, so there is no strand per waiting item.
+    Returns the list of results, in the order of the items if ordered, or else in the order the calls finished.
+
+    To stream results instead, pass on_result, which is called like fn with (item, result) as soon as each result is
+    available, in the same order.  Results are then not kept, and Map returns None.
+    """
+    if concurrency is None:
+        items = list(items)
+        concurrency = len(items)
+    elif concurrency < 1:
+        raise TapystryError(f"Map concurrency should be at least 1, got {concurrency}")
+    remaining = enumerate(items)
+    results = []
+    # for streaming in order: results which finished ahead of an earlier item, by index
+    finished = dict()
+    next_index = 0
+    flushing = False
+
+    def stream_in_order(index, item, result):
+        nonlocal next_index, flushing
+        finished[index] = (item, result)
+        if flushing:
+            # whoever is flushing will get to it, so results aren't streamed out of order
+            return
+        flushing = True
+        while next_index in finished:
+            item, result = finished.pop(next_index)
+            next_index += 1
+            yield Call(on_result, (item, result))
+        flushing = False
+
+    def worker():
+        # each worker takes the next item once its previous call finishes
+        for index, item in remaining:
+            if on_result is not None:
+                result = yield Call(fn, (item,))
+                if ordered:
+                    yield Call(stream_in_order, (index, item, result))
+                else:
+                    yield Call(on_result, (item, result))
+                continue
+            if ordered:
+                results.append(None)
+            result = yield Call(fn, (item,))
+            if ordered:
+                results[index] = result
+            else:
+                results.append(result)
+
+    if concurrency:
+        workers = yield ForkMany([Call(worker) for _ in range(concurrency)])
+        yield JoinAll(workers)
+    if on_result is not None:
+        return None
+    return results
 
 
 @as_effect("Subscribe", forked=True)
-def Subscribe(message_key, fn, predicate=None, leading_only=False, latest_only=False):
+def Subscribe(message_key, fn, predicate=None, leading_only=False, latest_only=False, match=None):
     """
     Upon receiving any message, runs the specified function on the sent value.
     Returns the strand running the subscription.
@@ -111,22 +176,10 @@ def Subscribe(message_key, fn, predicate=None, leading_only=False, latest_only=F
 
     task = None
     while True:
-        msg = yield Receive(message_key, predicate=predicate)
+        msg = yield Receive(message_key, predicate=predicate, match=match)
         if leading_only:
             yield Call(fn, (msg,))
         else:
             if latest_only and task is not None:
                 yield Cancel(task)
             task = yield CallFork(fn, (msg,))
-
-
-@as_effect("Sleep")
-def Sleep(t, increment=0.1):
-    "Sleep - can be canceled every increment seconds"
-    start = time.time()
-    if t < 0:
-        raise ValueError("sleep length must be non-negative")
-    while True:
-        yield CallThread(time.sleep, args=(min(increment, t),))
-        if time.time() - start >= t:
-            break
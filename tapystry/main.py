@@ -1,25 +1,78 @@
 from functools import partial
 import threading
-import queue
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import inspect
+import linecache
 import abc
+import asyncio
+import sys
 from collections import defaultdict, deque
+import heapq
+import itertools
 from uuid import uuid4
 import types
 import time
+import warnings
+
+
+CAPTURE_CALLERS_MODES = ("off", "lazy", "full")
+
+# name of the thread pool sized by max_threads, used by CallThread unless it names another pool
+_DEFAULT_POOL = "default"
+
+# capture mode of the engine running on this thread
+_capture_settings = threading.local()
+
+
+class _Caller():
+    """
+    Where an effect or strand was created.
+    Only the code object and line number are stored; everything else is looked up when debugging output asks for it.
+    """
+    __slots__ = ("_code", "lineno")
+
+    def __init__(self, code, lineno):
+        self._code = code
+        self.lineno = lineno
+
+    @property
+    def filename(self):
+        return self._code.co_filename
+
+    @property
+    def function(self):
+        return self._code.co_name
+
+    @property
+    def code_context(self):
+        line = linecache.getline(self.filename, self.lineno)
+        if not line:
+            return None
+        return [line]
+
 
 def get_nth_frame(n):
-    frame = inspect.currentframe()
-    for _ in range(n+1):
-        frame = frame.f_back
+    mode = getattr(_capture_settings, "mode", "lazy")
+    if mode == "off":
+        return None
+    frame = sys._getframe(n + 1)
+    if mode == "lazy":
+        return _Caller(frame.f_code, frame.f_lineno)
     return inspect.getframeinfo(frame)
 
 
+def _set_capture_mode(capture_callers):
+    prev_mode = getattr(_capture_settings, "mode", "lazy")
+    _capture_settings.mode = capture_callers
+    return prev_mode
+
+
 class Effect(metaclass=abc.ABCMeta):
     """
     Base class for effects which can be yielded to the tapystry event loop.
     """
+    __slots__ = ("type", "cancel", "name", "_caller", "immediate")
+
     def __init__(self, type, oncancel=(lambda: None), name=None, caller=None, caller_stack_index=2, immediate=True):
         self.type = type
         self.cancel = oncancel
@@ -41,6 +94,8 @@ class Wrapper(Effect):
     """
     Wrapper around another effect which modifies the type
     """
+    __slots__ = ("effect",)
+
     def __init__(self, effect, type, **effect_kwargs):
         self.effect = effect
         super().__init__(type=type, **effect_kwargs)
@@ -51,6 +106,8 @@ class Broadcast(Effect):
     """
     Effect which broadcasts a message for all strands to hear
     """
+    __slots__ = ("key", "value")
+
     def __init__(self, key, value=None, name=None, immediate=False, **effect_kwargs):
         self.key = key
         self.value = value
@@ -63,10 +120,24 @@ class Receive(Effect):
     """
     Effect which waits until it hears a broadcast at the specified key, with value satisfying the specified predicate.
     The tapystry engine returns the matched message's value
+
+    match is a dict from field to value, and requires value[field] == match[field] for each field.
+    Unlike predicates, matches are indexed by the engine, so a broadcast only visits receivers it matches.
+
+    If timeout is set, a TimeoutError is raised in the receiving strand if nothing is received within that many seconds.
     """
-    def __init__(self, key, predicate=None, name=None, **effect_kwargs):
+    __slots__ = ("key", "predicate", "match", "timeout")
+
+    def __init__(self, key, predicate=None, name=None, match=None, timeout=None, **effect_kwargs):
         self.key = key
         self.predicate = predicate
+        if match is not None:
+            try:
+                hash(tuple(match.values()))
+            except TypeError:
+                raise TapystryError(f"Receive match values must be hashable, since they are indexed: {match}")
+        self.match = match
+        self.timeout = timeout
         if name is None:
             name = key
         super().__init__(type="Receive", name=name, **effect_kwargs)
@@ -77,6 +148,8 @@ class Call(Effect):
     Effect which spins up a new strand by calling generator on the specified arguments,
     The tapystry engine returns the generator's return value
     """
+    __slots__ = ("gen", "args", "kwargs")
+
     def __init__(self, gen, args=(), kwargs=None, name=None, **effect_kwargs):
         self.gen = gen
         self.args = args
@@ -91,6 +164,8 @@ class CallFork(Effect):
     Effect which spins up a new strand by calling generator on the specified arguments
     The tapystry engine immediately returns a Strand object.
     """
+    __slots__ = ("gen", "args", "kwargs", "run_first")
+
     def __init__(self, gen, args=(), kwargs=None, name=None, run_first=False, **effect_kwargs):
         self.gen = gen
         self.args = args
@@ -103,22 +178,100 @@ class CallFork(Effect):
 
 class CallThread(Effect):
     """
-    # TODO: make this thread able to yield back to the event loop?
     Effect which spins up a function in a new thread
     The tapystry engine returns the function's return value
     NOTE: what runs within the thread
-    - is *not* a generator, it cannot yield effects back
-    - can *not* be canceled
+    - is *not* a generator, but with pass_context=True, f is passed a ThreadContext as the `context` keyword argument,
+      whose run method yields effects back to the event loop on its behalf
+    - can *not* be interrupted, but canceling the strand cancels the call if it hasn't started running yet.
+      With pass_context=True, f can also check the context to stop early once the strand is canceled.
+    pool names one of the pools the engine was created with, to run f in instead of the default pool.
     """
-    def __init__(self, f, args=(), kwargs=None, name=None, **effect_kwargs):
+    __slots__ = ("f", "args", "kwargs", "pass_context", "pool")
+
+    def __init__(self, f, args=(), kwargs=None, name=None, pass_context=False, pool=None, **effect_kwargs):
         self.f = f
         self.args = args
         self.kwargs = kwargs or dict()
+        self.pass_context = pass_context
+        self.pool = pool
         if name is None:
             name = f.__name__
         super().__init__(type="CallThread", name=name, **effect_kwargs)
 
 
+class ThreadContext():
+    """
+    Passed to functions run by CallThread(..., pass_context=True), for cooperating with the engine
+    """
+    __slots__ = ("canceled", "_engine", "_strand", "_pending")
+
+    def __init__(self, engine, strand):
+        # set once the strand waiting on the call is canceled
+        self.canceled = threading.Event()
+        self._engine = engine
+        self._strand = strand
+        # futures for effects passed to run which haven't finished.  Only used from the event loop
+        self._pending = set()
+
+    def is_canceled(self):
+        return self.canceled.is_set()
+
+    def run(self, effect):
+        """
+        Yields effect from a new child of the strand waiting on the call, blocks until it is done, and returns its result.
+        Exceptions raised by the effect are raised here, and concurrent.futures.CancelledError is raised
+        if the strand is canceled in the meantime.
+        NOTE: this keeps a worker of the thread pool busy while waiting
+        """
+        engine = self._engine
+        if threading.current_thread() is engine._loop_thread:
+            raise TapystryError("ThreadContext.run can't be called from the event loop")
+        engine._check_open()
+        future = Future()
+        engine._post(partial(engine._run_from_thread, self, effect, future))
+        return future.result()
+
+    def _cancel(self):
+        self.canceled.set()
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+
+
+class CallProcess(Effect):
+    """
+    Effect which runs a function in a separate process, for CPU-bound work that would otherwise hold the GIL.
+    f, args, kwargs and the return value must be picklable.
+    The tapystry engine returns the function's return value
+    NOTE: canceling the strand only cancels the call if it hasn't started running yet
+    """
+    __slots__ = ("f", "args", "kwargs")
+
+    def __init__(self, f, args=(), kwargs=None, name=None, **effect_kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs or dict()
+        if name is None:
+            name = getattr(f, "__name__", None) or type(f).__name__
+        super().__init__(type="CallProcess", name=name, **effect_kwargs)
+
+
+class Await(Effect):
+    """
+    Effect which awaits an awaitable (e.g. a coroutine) on the asyncio event loop, without using a thread.
+    Can only be used in strands started with run_async.
+    The tapystry engine returns the awaitable's result
+    """
+    __slots__ = ("awaitable",)
+
+    def __init__(self, awaitable, name=None, **effect_kwargs):
+        self.awaitable = awaitable
+        if name is None:
+            name = getattr(awaitable, "__qualname__", None) or type(awaitable).__name__
+        super().__init__(type="Await", name=name, **effect_kwargs)
+
 
 class First(Effect):
     """
@@ -127,6 +280,8 @@ class First(Effect):
     NOTE: Use of this can be dangerous and can lead to deadlocks, as it cancels losers.
           It is safer to us higher-level APIs such as Race and Join
     """
+    __slots__ = ("strands", "cancel_losers", "ensure_cancel")
+
     def __init__(self, strands, name=None, cancel_losers=True, ensure_cancel=None, **effect_kwargs):
         self.strands = strands
         self.cancel_losers = cancel_losers
@@ -139,12 +294,72 @@ class First(Effect):
         super().__init__(type="Race", name=name, **effect_kwargs)
 
 
+class ForkMany(Effect):
+    """
+    Effect which runs each of a list of effects in a new strand, all in one step.
+    The tapystry engine immediately returns the list of strands, whose results are the effects' results.
+    """
+    __slots__ = ("effects", "run_first")
+
+    def __init__(self, effects, name=None, run_first=False, **effect_kwargs):
+        for effect in effects:
+            if not isinstance(effect, Effect):
+                raise TapystryError(f"Input to ForkMany should be a list of Effects: {effects}")
+        self.effects = effects
+        self.run_first = run_first
+        if name is None:
+            name = f"{len(effects)} effects"
+        super().__init__(type="ForkMany", name=name, **effect_kwargs)
+
+
+class Race(Effect):
+    """
+    Effect which runs each of the effects (a list or dict of them) in its own strand, until the first one finishes.
+    The others are canceled.
+    The tapystry engine returns a tuple with the key of the winning item, and its value
+    """
+    __slots__ = ("keys", "effects")
+
+    def __init__(self, effects, name=None, ensure_cancel=None, **effect_kwargs):
+        if ensure_cancel is not None:
+            # losers are canceled as soon as the first effect finishes, so they can never have completed too
+            warnings.warn("Race's ensure_cancel has no effect and will be removed", DeprecationWarning, stacklevel=2)
+        if isinstance(effects, list):
+            self.keys = range(len(effects))
+            self.effects = effects
+        else:
+            if not isinstance(effects, dict):
+                raise TapystryError(f"Input to Race should be a list or dict of Effects: {effects}")
+            self.keys = list(effects.keys())
+            self.effects = list(effects.values())
+        for effect in self.effects:
+            if not isinstance(effect, Effect):
+                raise TapystryError(f"Input to Race should be a list or dict of Effects: {effects}")
+        super().__init__(type="Race", name=name, **effect_kwargs)
+
+
+class JoinAll(Effect):
+    """
+    Effect which returns once all of the strands are done.
+    The tapystry engine returns a list of their results, in the same order.
+    """
+    __slots__ = ("strands",)
+
+    def __init__(self, strands, name=None, **effect_kwargs):
+        self.strands = strands
+        if name is None:
+            name = f"{len(strands)} strands"
+        super().__init__(type="JoinAll", name=name, **effect_kwargs)
+
+
 # TODO: does this really need to be an effect?  what's wrong with just exposing _canceled on Strand?
 class Cancel(Effect):
     """
     Effect which cancels the strand specified
     Cancels recursively, even with forks
     """
+    __slots__ = ("strand",)
+
     def __init__(self, strand, name=None, **effect_kwargs):
         self.strand = strand
         if name is None:
@@ -158,6 +373,8 @@ class Intercept(Effect):
     This is intended for testing only, and can only be used in test_mode.
     The tapystry engine returns a tuple of (effect, inject), where `effect` is the effect intercepted, and `inject` is a function taking a value, and returning an effect that yields that value for the intercepted effect.
     """
+    __slots__ = ("predicate",)
+
     def __init__(self, predicate=None, name=None, **effect_kwargs):
         self.predicate = predicate
         if name is None:
@@ -165,11 +382,48 @@ class Intercept(Effect):
         super().__init__(type="Intercept", name=name, **effect_kwargs)
 
 
+class Sleep(Effect):
+    """
+    Effect which waits for t seconds, without using a thread.
+    Sleep(0) wakes the strand once the engine has no other effects to handle.
+    Longer sleeps wake the strand once they are due, even if other strands keep the engine busy.
+    Canceling a sleeping strand frees its timer immediately.
+    increment is accepted for compatibility, and ignored: the sleep can be canceled at any time.
+    """
+    __slots__ = ("seconds",)
+
+    def __init__(self, t, increment=None, name=None, **effect_kwargs):
+        if t < 0:
+            raise ValueError("sleep length must be non-negative")
+        self.seconds = t
+        super().__init__(type="Sleep", name=name, **effect_kwargs)
+
+
+class Timeout(Effect):
+    """
+    Effect which does the given effect, raising TimeoutError in the strand if it takes longer than the specified seconds.
+    The effect is canceled if it times out.
+    The tapystry engine returns the effect's value
+    """
+    __slots__ = ("effect", "seconds")
+
+    def __init__(self, effect, seconds, name=None, **effect_kwargs):
+        if seconds < 0:
+            raise ValueError("timeout must be non-negative")
+        self.effect = effect
+        self.seconds = seconds
+        if name is None:
+            name = f"{effect}, {seconds}"
+        super().__init__(type="Timeout", name=name, **effect_kwargs)
+
+
 class DebugTree(Effect):
     """
     Effect which returns the state of the entire tapystry engine
     TODO: make the return value more structured (currently just a string)
     """
+    __slots__ = ()
+
     def __init__(self, **effect_kwargs):
         super().__init__(type="DebugTree", **effect_kwargs)
 
@@ -179,22 +433,244 @@ class TapystryError(Exception):
     pass
 
 
-_noval = object()
+def _strand_error(strand, message):
+    """
+    A TapystryError raised on behalf of strand, so that a serving engine fails only its root strand
+    """
+    error = TapystryError(message)
+    error.strand = strand
+    return error
+
+
+class _ReceiveWaiters():
+    """
+    Strands waiting on a single broadcast key, each mapped to (registration order, predicate, match).
+    Strands receiving with a match are indexed by the values of the matched fields.
+    """
+    __slots__ = ("unindexed", "indexed")
+
+    def __init__(self):
+        self.unindexed = dict()
+        # dict from tuple of fields to dict from tuple of values to waiting strands
+        self.indexed = dict()
+
+    def __bool__(self):
+        return bool(self.unindexed or self.indexed)
+
+    def add(self, strand, seq, predicate, match):
+        if not match:
+            self.unindexed[strand] = (seq, predicate, match)
+            return
+        fields = tuple(match.keys())
+        values = tuple(match.values())
+        index = self.indexed.get(fields)
+        if index is None:
+            index = self.indexed[fields] = dict()
+        group = index.get(values)
+        if group is None:
+            group = index[values] = dict()
+        group[strand] = (seq, predicate, match)
+
+    def discard(self, strand, match):
+        if not match:
+            self.unindexed.pop(strand, None)
+            return
+        fields = tuple(match.keys())
+        index = self.indexed.get(fields)
+        if index is None:
+            return
+        values = tuple(match.values())
+        group = index.get(values)
+        if group is None:
+            return
+        group.pop(strand, None)
+        # drop emptied levels, so keys that are never broadcast to again don't stick around
+        if not group:
+            del index[values]
+            if not index:
+                del self.indexed[fields]
+
+    def candidates(self, value):
+        """
+        Returns a list of (strand, predicate, match) for strands which might receive value, in registration order
+        """
+        groups = []
+        if self.unindexed:
+            groups.append(self.unindexed)
+        for fields, index in self.indexed.items():
+            try:
+                values = tuple([value[field] for field in fields])
+                group = index.get(values)
+            except (KeyError, IndexError, TypeError):
+                continue
+            if group:
+                groups.append(group)
+        if len(groups) == 1:
+            return [(strand, predicate, match) for strand, (_, predicate, match) in groups[0].items()]
+        items = [
+            (seq, strand, predicate, match)
+            for group in groups for strand, (seq, predicate, match) in group.items()
+        ]
+        items.sort(key=lambda x: x[0])
+        return [(strand, predicate, match) for (_, strand, predicate, match) in items]
+
+
+# returned by Strand.send when the strand has finished
+_done = object()
+
+
+class _Timer():
+    """
+    An entry in the engine's timer heap.
+    Canceled timers stay in the heap until they reach the top, or until the heap is compacted.
+    """
+    __slots__ = ("deadline", "seq", "callback", "_engine")
+
+    def __init__(self, deadline, seq, callback, engine):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self._engine = engine
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+    def cancel(self):
+        if self.callback is None:
+            return
+        self.callback = None
+        self._engine._timer_canceled()
+
+
+class _ThreadPool():
+    """
+    A thread pool for CallThread, which keeps count of the calls waiting for a worker and running
+    """
+    __slots__ = ("executor", "max_workers", "queued", "running", "completed", "_lock")
+
+    def __init__(self, name, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"tapystry-{name}")
+        self.max_workers = max_workers
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        # the counts are updated from the workers
+        self._lock = threading.Lock()
+
+    def submit(self, f, args, kwargs):
+        with self._lock:
+            self.queued += 1
+        return self.executor.submit(self._call, f, args, kwargs)
+
+    def _call(self, f, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def cancel(self, future, context=None):
+        if future.cancel():
+            with self._lock:
+                self.queued -= 1
+        elif context is not None:
+            # already running, so ask it to stop
+            context._cancel()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                max_workers=self.max_workers, queued=self.queued, running=self.running, completed=self.completed,
+            )
+
+
+class _Race():
+    """
+    The strands running the effects of a Race, until one of them finishes
+    """
+    __slots__ = ("engine", "strand", "keys", "branches", "done")
+
+    def __init__(self, engine, strand, keys):
+        self.engine = engine
+        self.strand = strand
+        self.keys = keys
+        self.branches = []
+        self.done = False
+
+    def receive(self, i, value):
+        if self.done:
+            return
+        self.done = True
+        engine = self.engine
+        for j, branch in enumerate(self.branches):
+            if j != i:
+                engine._cancel_strand(branch)
+        self.branches = None
+        engine._hanging_strands.pop(self.strand, None)
+        engine.advance(self.strand, (self.keys[i], value))
+
+
+class _JoinAll():
+    """
+    Countdown of the strands a JoinAll effect is still waiting for
+    """
+    __slots__ = ("engine", "strand", "results", "remaining")
+
+    def __init__(self, engine, strand, count):
+        self.engine = engine
+        self.strand = strand
+        self.results = [None] * count
+        self.remaining = count
+
+    def receive(self, i, value):
+        self.results[i] = value
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.engine._hanging_strands.pop(self.strand, None)
+            self.engine.advance(self.strand, self.results)
 
 
 class Strand():
-    def __init__(self, caller, gen, args=(), kwargs=None, *, parent, edge=None):
+    __slots__ = (
+        "_caller", "_future", "_it", "_done", "_result", "id", "_uuid",
+        "_live_children", "_parent", "_canceled", "_effect", "_parent_effect", "_edge", "_frames",
+    )
+
+    def __init__(self, caller, gen, args=(), kwargs=None, *, parent, edge=None, id=0):
         if kwargs is None:
             kwargs = dict()
+        self._setup(caller, gen(*args, **kwargs), parent, edge, id)
+
+    @classmethod
+    def _started(cls, caller, it, effect, *, parent, edge=None, id=0):
+        """
+        Creates a strand for a generator which already yielded effect
+        """
+        strand = cls.__new__(cls)
+        strand._setup(caller, it, parent, edge, id)
+        strand._effect = effect
+        return strand
+
+    def _setup(self, caller, it, parent, edge, id):
         self._caller = caller
         self._future = None
 
-        self._it = gen(*args, **kwargs)
+        self._it = it
+        # (generator, effect it yielded, Call effect handled for it) for each inline call the strand is in,
+        # outermost first
+        self._frames = None
         self._done = False
         self._result = None
-        self.id = uuid4()
+        # unique within an engine, see uuid for a globally unique id
+        self.id = id
+        self._uuid = None
         # self._error = None
-        self._live_children = []
+        # dict used as an ordered set, for constant time removal
+        self._live_children = dict()
         self._parent = parent
         self._canceled = False
         if not isinstance(self._it, types.GeneratorType):
@@ -203,10 +679,12 @@ class Strand():
         self._effect = None
         if self._parent is None:
             self._parent_effect = None
+            self._edge = None
             assert edge is None
         else:
             assert not self._parent._canceled
-            self._parent._live_children.append(self)
+            if not self._done:
+                self._parent._live_children[self] = None
             self._parent_effect = self._parent._effect
             self._edge = edge
             assert self._parent_effect is not None
@@ -214,63 +692,127 @@ class Strand():
 
     def remove_live_child(self, x):
         assert self._live_children
-        self._live_children.remove(x)
+        del self._live_children[x]
         if (self._done or self._canceled) and not self._live_children:
             if self._parent is not None:
                 assert self in self._parent._live_children
                 self._parent.remove_live_child(self)
 
     def send(self, value=None):
+        """
+        Resumes the strand, returning the next effect it yields, or _done if it finished
+        """
         assert not self._canceled
         assert not self._done
         try:
             effect = self._it.send(value)
             self._effect = effect
-            return dict(done=False, effect=effect)
+            return effect
         except StopIteration as e:
-            self._done = True
-            if self._parent is not None:
-                if not self._live_children:
-                    self._parent.remove_live_child(self)
-            self._result = e.value
-            self._effect = None
-            return dict(done=True)
+            if self._frames:
+                return self._return_inline(e.value)
+            return self._finish(e.value)
         except Exception as e:
-            tb = e.__traceback__.tb_next
-            line = tb.tb_lineno
-            # line = tb.tb_frame.f_code.co_firstlineno
-            # line number is not exactly right?
-            raise TapystryError(
-                "\n".join([
-                    f"Exception caught at",
-                    f"{self.stack()}",
-                    f":",
-                    f"File {tb.tb_frame.f_code.co_filename}, line {line}, in {tb.tb_frame.f_code.co_name}",
-                    f"{type(e).__name__}: {e}",
-                ])
-            )
+            raise self._error(e)
+
+    def throw(self, exc):
+        """
+        Raises exc in the strand where it is waiting, returning the next effect it yields, or _done if it finished
+        """
+        assert not self._canceled
+        assert not self._done
+        try:
+            effect = self._it.throw(exc)
+            self._effect = effect
+            return effect
+        except StopIteration as e:
+            if self._frames:
+                return self._return_inline(e.value)
+            return self._finish(e.value)
+        except Exception as e:
+            raise self._error(e)
+
+    def _call_inline(self, it, effect):
+        """
+        Runs generator it in place of the strand's current one, which yielded the Call effect,
+        until it returns.  Like a child strand, exceptions escaping it are not raised in the caller.
+        """
+        if self._frames is None:
+            self._frames = []
+        self._frames.append((self._it, self._effect, effect))
+        self._it = it
+
+    def _return_inline(self, result):
+        # resume callers until one yields an effect, without recursing, since many may return at once
+        frames = self._frames
+        while frames:
+            self._it = frames.pop()[0]
+            try:
+                effect = self._it.send(result)
+                self._effect = effect
+                return effect
+            except StopIteration as e:
+                result = e.value
+            except Exception as e:
+                raise self._error(e)
+        return self._finish(result)
+
+    def _finish(self, result):
+        self._done = True
+        if self._parent is not None:
+            if not self._live_children:
+                self._parent.remove_live_child(self)
+        self._result = result
+        self._effect = None
+        return _done
+
+    def _error(self, e):
+        tb = e.__traceback__.tb_next
+        line = tb.tb_lineno
+        # line = tb.tb_frame.f_code.co_firstlineno
+        # line number is not exactly right?
+        error = TapystryError(
+            "\n".join([
+                f"Exception caught at",
+                f"{self.stack()}",
+                f":",
+                f"File {tb.tb_frame.f_code.co_filename}, line {line}, in {tb.tb_frame.f_code.co_name}",
+                f"{type(e).__name__}: {e}",
+            ])
+        )
+        # lets a serving engine fail only the root strand this came from
+        error.strand = self
+        return error
 
-    def __hash__(self):
-        return self.id.int
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = uuid4()
+        return self._uuid
 
     def __str__(self):
-        return f"Strand[{self.id.hex}] (waiting for {self._effect})"
+        return f"Strand[{self.id}] (waiting for {self._effect})"
 
     def _debuglines(self):
-        return [
-            f"File {self._caller.filename}, line {self._caller.lineno}, in {self._caller.function}",
-            f"  {self._caller.code_context[0].strip()}",
-        ]
+        return _caller_lines(self._caller)
+
+    def _inline_lines(self, indent=0):
+        # inline calls show up the way child strands for them would
+        lines = []
+        for _, effect, call in self._frames or ():
+            lines.append(" " * indent + f"Yields effect {effect}, created at")
+            lines.extend(" " * indent + line for line in _caller_lines(call._caller))
+        return lines
 
     def stack(self, indent=0):
         # if self._parent is None:
-        #     return [f"Strand[{self.id.hex}]"]
+        #     return [f"Strand[{self.id}]"]
         # else:
         #     stack = list(self._parent.stack())
-        #     stack.append(f"{self._parent[1]} Strand[{self.id.hex}]")
+        #     stack.append(f"{self._parent[1]} Strand[{self.id}]")
         #     return stack
 
-        s = "\n".join(self._debuglines())
+        s = "\n".join(self._debuglines() + self._inline_lines(indent))
         if self._parent is None:
             return s
         else:
@@ -282,6 +824,7 @@ class Strand():
 
     def _treelines(self, indent=0):
         lines = [" " * indent + line for line in self._debuglines()]
+        lines.extend(self._inline_lines(indent))
         for c in self._live_children:
             lines.extend(
                 c._treelines(indent + 2)
@@ -301,7 +844,10 @@ class Strand():
 
     def cancel(self):
         # if self._done:  ??
-        if self._effect is not None:
+        if self._frames:
+            for _, effect, _ in self._frames:
+                effect.cancel()
+        if isinstance(self._effect, Effect):
             self._effect.cancel()
         self._canceled = True
 
@@ -309,6 +855,15 @@ class Strand():
         return self._canceled
 
 
+def _caller_lines(caller):
+    if caller is None:
+        return ["(caller not captured, use capture_callers='lazy' or 'full')"]
+    lines = [f"File {caller.filename}, line {caller.lineno}, in {caller.function}"]
+    if caller.code_context:
+        lines.append(f"  {caller.code_context[0].strip()}")
+    return lines
+
+
 def _indented(lines):
     indent = 0
     s = ""
@@ -318,72 +873,321 @@ def _indented(lines):
     return s
 
 
-class _QueueItem():
-    def __init__(self, effect, strand):
-        self.strand = strand
-        self.effect = effect
+# dict from effect class to handler function
+_effect_handlers = dict()
+# dict from effect class to resolved handler function (possibly inherited from a base class)
+_handler_cache = dict()
+
+
+def register_handler(effect_type, handler=None):
+    """
+    Registers a handler for an Effect subclass, so that strands can yield it directly.
+    The handler is called as handler(engine, strand, effect), and is responsible for eventually
+    resuming the strand, e.g. via engine.advance(strand, value).
+    Subclasses of effect_type use the same handler, unless they register their own.
+
+    Can be used as a decorator:
+        @register_handler(MyEffect)
+        def handle_my_effect(engine, strand, effect):
+            engine.advance(strand, effect.value)
+    """
+    if not (isinstance(effect_type, type) and issubclass(effect_type, Effect)):
+        raise TapystryError(f"Can only register handlers for Effect subclasses, got {effect_type}")
+
+    def decorator(handler):
+        _effect_handlers[effect_type] = handler
+        _handler_cache.clear()
+        return handler
+
+    if handler is None:
+        return decorator
+    return decorator(handler)
+
+
+def _resolve_handler(effect_type):
+    handler = _handler_cache.get(effect_type)
+    if handler is None:
+        for cls in effect_type.__mro__:
+            handler = _effect_handlers.get(cls)
+            if handler is not None:
+                _handler_cache[effect_type] = handler
+                break
+    return handler
 
 
-def run(gen, args=(), kwargs=None, debug=False, test_mode=False, max_threads=None):
-    # dict from string to waiting functions
-    waiting = defaultdict(list)
-    # dict from strand to waiting key
-    # TODO: gc hanging strands
-    hanging_strands = set()
+class Engine():
+    """
+    The tapystry event loop, along with its thread and process pools.
+    Can run many root strands, one after another via run, or together via submit, and should be closed when done.
 
-    q = deque()
+    max_threads and max_processes size the pools used by CallThread and CallProcess.
+    pools maps names to sizes of additional thread pools, which CallThread(..., pool=name) can use
+    to keep different kinds of work (e.g. slow database calls and fast cache lookups) from starving each other.
 
-    # list of intercept items
-    intercepts = []
+    capture_callers controls how the creation site of effects and strands is recorded, for stack traces:
+    - "full" looks up file, function and source line when each effect is created
+    - "lazy" only remembers the code object and line number, and looks up the rest when needed
+    - "off" records nothing
 
-    initial_strand = Strand(get_nth_frame(1), gen, args, kwargs, parent=None)
-    if initial_strand.is_done():
-        # wasn't even a generator
-        return initial_strand.get_result()
+    With inline_calls=True, Call runs the called generator on the calling strand, instead of in a child strand.
+    This cuts the cost of layered helpers (e.g. as_effect functions, Lock.Acquire or Queue.Get) a lot,
+    while cancellation and stack traces work as before.
 
-    def queue_effect(effect, strand):
+    Handlers registered via register_handler receive the engine, and should use
+    advance(strand, value) to resume a strand, and handle(strand, effect) to handle an effect on its behalf.
+    """
+    def __init__(
+        self, debug=False, test_mode=False, max_threads=None, max_processes=None, capture_callers="lazy", pools=None,
+        inline_calls=False,
+    ):
+        if capture_callers not in CAPTURE_CALLERS_MODES:
+            raise ValueError(f"capture_callers should be one of {CAPTURE_CALLERS_MODES}, got {capture_callers!r}")
+        if pools is not None and _DEFAULT_POOL in pools:
+            raise ValueError(f"The {_DEFAULT_POOL!r} pool is sized by max_threads")
+        self.debug = debug
+        self.test_mode = test_mode
+        self.capture_callers = capture_callers
+        self.inline_calls = inline_calls
+        # dict from broadcast key to _ReceiveWaiters
+        self._waiting = dict()
+        self._receive_seq = itertools.count()
+        # dict from receiving strand to the _Timer for its timeout
+        self._receive_timers = dict()
+        # dict from strand to functions waiting for it to finish, each in a dict used as an ordered set so that
+        # waiters which are canceled can be dropped in constant time
+        self._done_waiting = defaultdict(dict)
+        self._strand_ids = itertools.count()
+        # dict from strands waiting on something other than the queue, to what needs cleaning up if it is canceled:
+        # the Receive effect it is parked on, a function, or None
+        self._hanging_strands = dict()
+        # strands whose current effect is waiting to be handled
+        self._q = deque()
+        # list of intercept items
+        self._intercepts = []
+        # dict from name to _ThreadPool
+        self._pools = {_DEFAULT_POOL: _ThreadPool(_DEFAULT_POOL, max_threads)}
+        for name, max_workers in (pools or dict()).items():
+            self._pools[name] = _ThreadPool(name, max_workers)
+        # created on first use of CallProcess, since starting processes is expensive
+        self._process_executor = None
+        self._max_processes = max_processes
+        # functions posted from other threads, to be called on the event loop
+        # (deque appends and pops are atomic, so no lock is needed)
+        self._inbox = deque()
+        # (key, value) of broadcasts from other threads, delivered one at a time whenever the queue is empty
+        self._external_broadcasts = deque()
+        # set whenever something is posted to the inbox while the loop is asleep
+        self._wakeup = threading.Event()
+        self._notify = self._wakeup.set
+        # whether the loop is (about to be) blocked waiting on the wakeup.  While it is awake, it drains the
+        # inbox before blocking again, so posting doesn't need to notify it, which saves a lock round trip
+        # per completion when many threads finish in a burst
+        self._sleeping = False
+        # dict from futures of threads (or awaitables) whose results haven't been consumed yet, to their strands
+        self._pending_external = dict()
+        # the asyncio loop, when run with run_async
+        self._loop = None
+        # heap of _Timers, and how many of them (including idle ones) are not canceled
+        self._timers = []
+        self._active_timers = 0
+        # _Timers with no delay, which only fire once the queue has drained
+        self._idle_timers = deque()
+        self._timer_seq = itertools.count()
+        # dict from root strand to the Future for its result
+        self._roots = dict()
+        self._running = False
+        # whether errors in strands only fail their own root strand, rather than the whole run
+        self._serving = False
+        # guards claiming the engine in _begin, which run and the serve thread can race on
+        self._begin_lock = threading.Lock()
+        self._closed = False
+        # thread running the event loop, while running
+        self._loop_thread = None
+        # background thread started by start()
+        self._serve_thread = None
+        self._stopping = False
+
+    def spawn(self, caller, gen, args=(), kwargs=None, *, parent, edge=None):
+        """
+        Creates a new strand calling gen on the specified arguments
+        """
+        return Strand(caller, gen, args, kwargs, parent=parent, edge=edge, id=next(self._strand_ids))
+
+    def _queue_effect(self, effect, strand):
         if not isinstance(effect, Effect):
-            raise TapystryError(f"Strand yielded non-effect {type(effect)}:\n\n{strand.stack()}")
+            raise _strand_error(strand, f"Strand yielded non-effect {type(effect)}:\n\n{strand.stack()}")
+        # the effect itself is found on strand._effect when handled
         if effect.immediate:
-            q.append(_QueueItem(effect, strand))
+            self._q.append(strand)
         else:
-            q.appendleft(_QueueItem(effect, strand))
+            self._q.appendleft(strand)
 
-    def advance_strand(strand, value=_noval):
-        if strand.is_canceled():
+    def advance(self, strand, value=None):
+        """
+        Resumes the strand with the specified value
+        """
+        if strand._canceled:
             return
-        if value == _noval:
-            result = strand.send()
-        else:
-            result = strand.send(value)
-        if result['done']:
-            resolve_waiting("done." + strand.id.hex, strand.get_result())
+        try:
+            effect = strand.send(value)
+            if effect is not _done:
+                self._queue_effect(effect, strand)
+                return
+        except Exception as e:
+            if not self._serving:
+                raise
+            # fail the strand's own root here, rather than whichever strand resumed it
+            self._fail(strand, e)
             return
-        effect = result['effect']
-        queue_effect(effect, strand)
+        self._resolve_done(strand)
 
-    def add_waiting_strand(key, strand, fn=None):
-        assert strand not in hanging_strands
-        hanging_strands.add(strand)
+    def throw(self, strand, exc):
+        """
+        Resumes the strand by raising exc in it
+        """
+        if strand._canceled:
+            return
+        try:
+            effect = strand.throw(exc)
+            if effect is not _done:
+                self._queue_effect(effect, strand)
+                return
+        except Exception as e:
+            if not self._serving:
+                raise
+            self._fail(strand, e)
+            return
+        self._resolve_done(strand)
+
+    def _add_joining_strand(self, strand, joined_strand):
+        """
+        Resumes strand with the result of joined_strand once it finishes
+        """
+        assert strand not in self._hanging_strands
 
         def receive(val):
-            assert strand in hanging_strands
-            if fn is not None and not fn(val):
-                return False
-            hanging_strands.remove(strand)
-            advance_strand(strand, val)
-            return True
-        waiting[key].append(receive)
-
-    def cancel_strand(strand):
+            self._hanging_strands.pop(strand, None)
+            self.advance(strand, val)
+        self._done_waiting[joined_strand][receive] = None
+        self._hanging_strands[strand] = partial(self._discard_done_waiters, [(joined_strand, receive)])
+
+    def _add_joining_all(self, strand, joined_strands):
+        """
+        Resumes strand with the list of results of joined_strands once they have all finished
+        """
+        join = _JoinAll(self, strand, len(joined_strands))
+        done_waiting = self._done_waiting
+        waiters = []
+        for i, joined_strand in enumerate(joined_strands):
+            if joined_strand.is_done():
+                join.results[i] = joined_strand._result
+                join.remaining -= 1
+            else:
+                fn = partial(join.receive, i)
+                done_waiting[joined_strand][fn] = None
+                waiters.append((joined_strand, fn))
+        if join.remaining == 0:
+            self.advance(strand, join.results)
+            return
+        assert strand not in self._hanging_strands
+        self._hanging_strands[strand] = partial(self._discard_done_waiters, waiters)
+
+    def _discard_done_waiters(self, waiters):
+        """
+        Stops (strand, fn) pairs from waiting for their strands to finish, once what they'd resume is canceled
+        """
+        done_waiting = self._done_waiting
+        for strand, fn in waiters:
+            fns = done_waiting.get(strand)
+            if fns is not None:
+                fns.pop(fn, None)
+                if not fns:
+                    del done_waiting[strand]
+
+    def _add_receiving_strand(self, strand, effect, timeout=None):
+        assert strand not in self._hanging_strands
+        self._hanging_strands[strand] = effect
+        waiters = self._waiting.get(effect.key)
+        if waiters is None:
+            waiters = self._waiting[effect.key] = _ReceiveWaiters()
+        waiters.add(strand, next(self._receive_seq), effect.predicate, effect.match)
+        if timeout is None:
+            timeout = effect.timeout
+        if timeout is not None:
+            self._receive_timers[strand] = self.call_later(
+                timeout, partial(self._receive_timed_out, strand, effect, timeout)
+            )
+
+    def _receive_timed_out(self, strand, effect, timeout):
+        del self._receive_timers[strand]
+        self._discard_receiving_strand(strand, effect)
+        del self._hanging_strands[strand]
+        effect.cancel()
+        self.throw(strand, TimeoutError(f"{effect} timed out after {timeout} seconds"))
+
+    def _discard_receiving_strand(self, strand, effect):
+        if self._receive_timers:
+            timer = self._receive_timers.pop(strand, None)
+            if timer is not None:
+                timer.cancel()
+        waiters = self._waiting.get(effect.key)
+        if waiters is None:
+            return
+        waiters.discard(strand, effect.match)
+        if not waiters:
+            del self._waiting[effect.key]
+
+    def _broadcast(self, key, value):
+        waiters = self._waiting.get(key)
+        if waiters is None:
+            return
+        candidates = waiters.candidates(value)
+        if self.debug:
+            print("broadcasting", key, len(candidates), value)
+        for strand, predicate, match in candidates:
+            if strand._canceled:
+                # canceled without going through the engine, e.g. via Strand.cancel
+                waiters.discard(strand, match)
+                self._hanging_strands.pop(strand, None)
+                continue
+            if strand not in self._hanging_strands:
+                continue
+            if predicate is not None and not predicate(value):
+                continue
+            waiters.discard(strand, match)
+            del self._hanging_strands[strand]
+            if self._receive_timers:
+                timer = self._receive_timers.pop(strand, None)
+                if timer is not None:
+                    timer.cancel()
+            self.advance(strand, value)
+        if not waiters and self._waiting.get(key) is waiters:
+            del self._waiting[key]
+
+    def _cancel_strand(self, strand):
+        self._cancel_tree(strand)
+        # detach from the parent, so canceled strands don't accumulate in long-lived parents
+        parent = strand._parent
+        if parent is not None and strand in parent._live_children:
+            parent.remove_live_child(strand)
+
+    def _cancel_tree(self, strand):
         strand.cancel()
-        waiting.pop("done." + strand.id.hex, None)
+        self._done_waiting.pop(strand, None)
+        cleanup = self._hanging_strands.pop(strand, None)
+        if cleanup is not None:
+            if isinstance(cleanup, Receive):
+                self._discard_receiving_strand(strand, cleanup)
+                if isinstance(strand._effect, Timeout):
+                    # strand.cancel() only reached the Timeout, not the receive it wraps
+                    cleanup.cancel()
+            else:
+                cleanup()
         for child in strand._live_children:
-            cancel_strand(child)
+            self._cancel_tree(child)
 
-    def add_racing_strand(racing_strands, race_strand, cancel_losers, ensure_cancel):
-        assert race_strand not in hanging_strands
-        hanging_strands.add(race_strand)
+    def _add_racing_strand(self, racing_strands, race_strand, cancel_losers, ensure_cancel):
+        assert race_strand not in self._hanging_strands
 
         received = False
 
@@ -399,152 +1203,889 @@ def run(gen, args=(), kwargs=None, debug=False, test_mode=False, max_threads=Non
                     if ensure_cancel:
                         assert not strand.is_done()
                     if cancel_losers:
-                        cancel_strand(strand)
+                        self._cancel_strand(strand)
             received = True
-            assert race_strand in hanging_strands
-            hanging_strands.remove(race_strand)
-            advance_strand(race_strand, (i, val))
+            discard_waiters = self._hanging_strands.pop(race_strand, None)
+            if discard_waiters is not None:
+                # losers that weren't canceled can't resume the race strand anymore either
+                discard_waiters()
+            self.advance(race_strand, (i, val))
 
         winner = None
         for i, strand in enumerate(racing_strands):
             if strand.is_done():
                 if winner is not None and ensure_cancel:
-                    raise TapystryError(f"Race between effects that are already completed")
+                    raise _strand_error(race_strand, f"Race between effects that are already completed")
                 winner = (i, strand)
         if winner is not None:
             (i, strand) = winner
             declare_winner(i, strand.get_result())
+            return
 
+        waiters = []
         for i, strand in enumerate(racing_strands):
-            waiting["done." + strand.id.hex].append(partial(declare_winner, i))
-
-    def resolve_waiting(wait_key, value):
-        fns = waiting[wait_key]
-        if debug:
-            print("resolving", wait_key, len(fns), value)
-        # clear first in case it mutates
-        waiting[wait_key] = [fn for fn in fns if not fn(value)]
-
-    def make_injector(intercepted_strand):
+            fn = partial(declare_winner, i)
+            self._done_waiting[strand][fn] = None
+            waiters.append((strand, fn))
+        self._hanging_strands[race_strand] = partial(self._discard_done_waiters, waiters)
+
+    def _resolve_done(self, strand):
+        # a strand only finishes once, so its waiters can be dropped
+        fns = self._done_waiting.pop(strand, None)
+        if self.debug:
+            print("resolving", strand, len(fns or ()), strand._result)
+        if fns:
+            for fn in fns:
+                fn(strand._result)
+
+    def _make_injector(self, intercepted_strand):
         def inject(value):
-            advance_strand(intercepted_strand, value)
-            hanging_strands.remove(intercepted_strand)
+            self.advance(intercepted_strand, value)
+            self._hanging_strands.pop(intercepted_strand, None)
         return lambda x: Call(inject, (x,))
 
-    threads_q = queue.Queue()
-    executor = ThreadPoolExecutor(max_workers=max_threads)
-    thread_strands = dict()  # dict from thread to callback
-
-    def handle_call_thread(effect, strand):
-        future = executor.submit(effect.f, *effect.args, **effect.kwargs)
-        id = uuid4()
-
-        def done_callback(f):
-            assert f == future
-            assert f.done()
-            if future.cancelled():
-                assert strand._canceled
-                threads_q.put((None, id))
-            else:
-                threads_q.put((f.result(), id))
-
-        thread_strands[id] = strand
-        future.add_done_callback(done_callback)
-
-    def handle_item(strand, effect):
-        if strand.is_canceled():
+    def _post(self, fn):
+        """
+        Schedules fn() to be called on the event loop.  Safe to call from any thread.
+        """
+        self._inbox.append(fn)
+        self._wake()
+
+    def _wake(self):
+        # the loop sets _sleeping before its last check of the inbox, so either it sees what was just
+        # posted, or we see that it is sleeping
+        if self._sleeping:
+            self._notify()
+
+    def _drain_inbox(self):
+        inbox = self._inbox
+        while inbox:
+            inbox.popleft()()
+
+    def _wait_external(self, strand, future):
+        """
+        Resumes strand with the outcome of a concurrent.futures or asyncio future, once it is done.
+        Exceptions are raised in the strand.
+        """
+        self._pending_external[future] = strand
+        future.add_done_callback(lambda f: self._post(partial(self._external_done, strand, f)))
+
+    def _external_done(self, strand, future):
+        if self._pending_external.pop(future, None) is None:
+            # left over from a run that was aborted
             return
-
-        if isinstance(effect, Intercept):
-            if not test_mode:
-                raise TapystryError(f"Cannot intercept outside of test mode!")
-            intercepts.append((strand, effect))
-            hanging_strands.add(strand)
+        if strand._canceled or future.cancelled():
+            return
+        self._hanging_strands.pop(strand, None)
+        exc = future.exception()
+        if exc is not None:
+            self.throw(strand, exc)
+        else:
+            self.advance(strand, future.result())
+
+    def _handle_call_thread(self, effect, strand):
+        pool = self._pools.get(_DEFAULT_POOL if effect.pool is None else effect.pool)
+        if pool is None:
+            raise _strand_error(strand, f"No thread pool named {effect.pool!r}: {strand.stack()}")
+        if effect.pass_context:
+            context = ThreadContext(self, strand)
+            future = pool.submit(effect.f, effect.args, dict(effect.kwargs, context=context))
+            self._hanging_strands[strand] = partial(pool.cancel, future, context)
+        else:
+            future = pool.submit(effect.f, effect.args, effect.kwargs)
+            # frees the worker if the call hasn't started by the time the strand is canceled
+            self._hanging_strands[strand] = partial(pool.cancel, future)
+        self._wait_external(strand, future)
+
+    def _run_from_thread(self, context, effect, future):
+        if context.is_canceled():
+            future.cancel()
+            return
+        context._pending.add(future)
+        strand = context._strand
+        child = self.spawn(strand._effect._caller, _yield_for_thread, (context, effect, future), parent=strand, edge="thread")
+        self.advance(child)
+
+    def pool_stats(self):
+        """
+        Returns a dict from thread pool name to counts of its calls, for monitoring:
+        max_workers, queued (waiting for a worker), running, and completed.
+        Safe to call from any thread.
+        """
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+    def _handle_call_process(self, effect, strand):
+        if self._process_executor is None:
+            self._process_executor = ProcessPoolExecutor(max_workers=self._max_processes)
+        future = self._process_executor.submit(effect.f, *effect.args, **effect.kwargs)
+        # frees the worker if the call hasn't started by the time the strand is canceled
+        self._hanging_strands[strand] = future.cancel
+        self._wait_external(strand, future)
+
+    def call_later(self, delay, callback):
+        """
+        Calls callback() from the event loop after delay seconds.
+        With no delay, it is only called once the engine has no other effects to handle.
+        Otherwise, it is called when due, even if other strands keep the engine busy.
+        Returns a timer which can be canceled with timer.cancel()
+        """
+        timer = _Timer(time.monotonic() + delay, next(self._timer_seq), callback, self)
+        if delay <= 0:
+            self._idle_timers.append(timer)
+        else:
+            heapq.heappush(self._timers, timer)
+        self._active_timers += 1
+        return timer
+
+    def _timer_canceled(self):
+        self._active_timers -= 1
+        # compact once most of the heap is canceled timers
+        if len(self._timers) > 64 and self._active_timers < len(self._timers) // 2:
+            self._timers = [timer for timer in self._timers if timer.callback is not None]
+            heapq.heapify(self._timers)
+
+    def _next_deadline(self):
+        timers = self._timers
+        while timers and timers[0].callback is None:
+            heapq.heappop(timers)
+        if not timers:
+            return None
+        return timers[0].deadline
+
+    def _fire_timers(self):
+        """
+        Fires the timers which are due, once the queue has drained
+        """
+        self._fire_due_timers()
+        idle = self._idle_timers
+        # not the ones added by these callbacks, which wait for the queue to drain again
+        for _ in range(len(idle)):
+            timer = idle.popleft()
+            callback = timer.callback
+            if callback is None:
+                continue
+            timer.callback = None
+            self._active_timers -= 1
+            callback()
+
+    def _fire_due_timers(self):
+        timers = self._timers
+        now = time.monotonic()
+        while timers and (timers[0].callback is None or timers[0].deadline <= now):
+            timer = heapq.heappop(timers)
+            callback = timer.callback
+            if callback is None:
+                continue
+            timer.callback = None
+            self._active_timers -= 1
+            callback()
+
+    def _while_busy(self):
+        """
+        Called every _BUSY_CHECK_INTERVAL effects while the queue hasn't drained, so that busy strands can't
+        keep timers from firing or external broadcasts from being delivered
+        """
+        timers = self._timers
+        if timers and timers[0].deadline <= time.monotonic():
+            self._fire_due_timers()
+        if self._external_broadcasts:
+            self._deliver_external_broadcast()
+
+    def _wait_timeout(self):
+        """
+        How long the loop may block waiting for threads, given pending timers
+        """
+        if self._idle_timers:
+            return 0
+        deadline = self._next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
+
+    def _try_intercept(self, strand, effect):
+        for (intercept_strand, intercept_effect) in self._intercepts:
+            if intercept_effect.predicate is None or intercept_effect.predicate(effect):
+                self._hanging_strands.pop(intercept_strand, None)
+                self._intercepts.remove((intercept_strand, intercept_effect))
+                self._hanging_strands[strand] = None
+                self.advance(intercept_strand, (effect, self._make_injector(strand)))
+                return True
+        return False
+
+    def handle(self, strand, effect):
+        """
+        Handles an effect yielded by the strand
+        """
+        if strand.is_canceled():
             return
 
-        if test_mode:
-            intercepted = False
-            for (intercept_strand, intercept_effect) in intercepts:
-                if intercept_effect.predicate is None or intercept_effect.predicate(effect):
-                    intercepted = True
-                    break
-            if intercepted:
-                hanging_strands.remove(intercept_strand)
-                intercepts.remove((intercept_strand, intercept_effect))
-                hanging_strands.add(strand)
-                advance_strand(intercept_strand, (effect, make_injector(strand)))
+        if self._intercepts and not isinstance(effect, Intercept):
+            if self._try_intercept(strand, effect):
                 return
 
-        if debug:
+        if self.debug:
             print(f"Handling {effect} (from {strand})")
             print(strand.stack(indent=2))
 
-        if not isinstance(effect, Effect):
-            raise TapystryError(f"Strand yielded non-effect {type(effect)}")
-
-        if isinstance(effect, Broadcast):
-            resolve_waiting("broadcast." + effect.key, effect.value)
-            advance_strand(strand)
-        elif isinstance(effect, Receive):
-            add_waiting_strand("broadcast." + effect.key, strand, effect.predicate)
-        elif isinstance(effect, Call):
-            call_strand = Strand(effect._caller, effect.gen, effect.args, effect.kwargs, parent=strand, edge=effect.name or "call")
-            if call_strand.is_done():
+        handler = _resolve_handler(type(effect))
+        if handler is None:
+            if not isinstance(effect, Effect):
+                raise _strand_error(strand, f"Strand yielded non-effect {type(effect)}")
+            raise _strand_error(strand, f"Unhandled effect type {type(effect)}: {strand.stack()}")
+        handler(self, strand, effect)
+
+    def _is_idle(self):
+        """
+        Whether there is nothing left that could resume a strand
+        """
+        return not (
+            self._q or self._inbox or self._external_broadcasts or self._pending_external or self._active_timers
+        )
+
+    def _check_open(self):
+        if self._closed or self._stopping:
+            raise TapystryError("Engine is closed")
+
+    def _add_root(self, root, future):
+        self._roots[root] = future
+        self._done_waiting[root][partial(self._root_done, root)] = None
+
+    def _root_done(self, root, result):
+        future = self._roots.pop(root)
+        future.set_result(result)
+
+    def _start_root(self, caller, gen, args, kwargs, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            root = self.spawn(caller, gen, args, kwargs, parent=None)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if root.is_done():
+            # wasn't even a generator
+            future.set_result(root.get_result())
+            return
+        self._add_root(root, future)
+        self.advance(root)
+
+    def submit(self, gen, args=(), kwargs=None):
+        """
+        Starts gen as a new root strand, without waiting for it.
+        It runs the next time the engine runs, alongside any other root strands.
+        Returns a concurrent.futures.Future for its result.
+        """
+        self._check_open()
+        future = Future()
+        self._post(partial(self._start_root, get_nth_frame(1), gen, args, kwargs, future))
+        return future
+
+    def broadcast(self, key, value=None):
+        """
+        Broadcasts a message to strands in the engine, like yielding Broadcast(key, value).
+        Safe to call from any thread.  The message is delivered as soon as the event loop has handled
+        everything already queued, and strands resumed by one message run before the next is delivered.
+        """
+        self._check_open()
+        self._external_broadcasts.append((key, value))
+        self._wake()
+
+    def _deliver_external_broadcast(self):
+        key, value = self._external_broadcasts.popleft()
+        self._broadcast(key, value)
+
+    def _begin(self):
+        with self._begin_lock:
+            self._check_open()
+            if self._running:
+                raise TapystryError("Engine is already running")
+            self._running = True
+            self._loop_thread = threading.current_thread()
+        self._prev_capture_mode = _set_capture_mode(self.capture_callers)
+
+    def _end(self):
+        self._running = False
+        self._serving = False
+        self._sleeping = False
+        self._loop_thread = None
+        _capture_settings.mode = self._prev_capture_mode
+
+    def run(self, gen, args=(), kwargs=None, caller=None):
+        """
+        Runs gen as a root strand, along with any submitted ones, until there is nothing left to do.
+        Returns the result of gen.
+        If the engine is serving on another thread, submits gen to it and waits for the result instead.
+        """
+        loop_thread = self._loop_thread
+        if loop_thread is not None and loop_thread is not threading.current_thread() and not self._stopping:
+            return self.submit(gen, args, kwargs).result()
+        self._begin()
+        try:
+            if caller is None:
+                caller = get_nth_frame(1)
+            root = self.spawn(caller, gen, args, kwargs, parent=None)
+            future = Future()
+            future.set_running_or_notify_cancel()
+            if root.is_done():
                 # wasn't even a generator
-                advance_strand(strand, call_strand.get_result())
+                future.set_result(root.get_result())
             else:
-                add_waiting_strand("done." + call_strand.id.hex, strand)
-                advance_strand(call_strand)
-        elif isinstance(effect, CallFork):
-            fork_strand = Strand(effect._caller, effect.gen, effect.args, effect.kwargs, parent=strand, edge=effect.name or "fork")
-            if not effect.run_first:
-                advance_strand(strand, fork_strand)
-            if not fork_strand.is_done():
-                # otherwise wasn't even a generator
-                advance_strand(fork_strand)
-            if effect.run_first:
-                advance_strand(strand, fork_strand)
-        elif isinstance(effect, CallThread):
-            handle_call_thread(effect, strand)
-        elif isinstance(effect, First):
-            add_racing_strand(effect.strands, strand, effect.cancel_losers, effect.ensure_cancel)
-        elif isinstance(effect, Cancel):
-            cancel_strand(effect.strand)
-            advance_strand(strand)
-        elif isinstance(effect, DebugTree):
-            advance_strand(strand, initial_strand.tree())
-        elif isinstance(effect, Wrapper):
-            handle_item(strand, effect.effect)
+                self._add_root(root, future)
+                self.advance(root)
+            self._run_until_idle()
+            self._check_hanging()
+            assert future.done()
+            return future.result()
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._end()
+
+    def run_until_idle(self):
+        """
+        Runs submitted root strands until there is nothing left to do
+        """
+        self._begin()
+        try:
+            self._run_until_idle()
+            self._check_hanging()
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._end()
+
+    def _run_until_idle(self):
+        q = self._q
+        inbox = self._inbox
+        countdown = _BUSY_CHECK_INTERVAL
+        while True:
+            if inbox:
+                self._drain_inbox()
+
+            if len(q):
+                strand = q.pop()
+                self.handle(strand, strand._effect)
+                countdown -= 1
+                if not countdown:
+                    countdown = _BUSY_CHECK_INTERVAL
+                    self._while_busy()
+                continue
+
+            if self._external_broadcasts:
+                self._deliver_external_broadcast()
+                continue
+            if self._active_timers:
+                self._fire_timers()
+            if self._is_idle():
+                break
+            if q:
+                continue
+
+            # nothing to do until a thread finishes or a timer is due
+            self._wakeup.clear()
+            self._sleeping = True
+            if not (inbox or self._external_broadcasts):
+                self._wakeup.wait(self._wait_timeout())
+            self._sleeping = False
+
+    def serve(self):
+        """
+        Runs the event loop until close() is called, serving root strands submitted from any thread.
+        Unlike run, an exception in a strand only fails the future of the root strand it belongs to,
+        and strands waiting on things that might never happen are not considered errors.
+        """
+        self._begin()
+        self._serve_until_closed()
+
+    def _serve_until_closed(self):
+        self._serving = True
+        try:
+            self._serve()
+        finally:
+            self._abort()
+            self._end()
+
+    def start(self):
+        """
+        Starts serving in a background thread.  Returns the engine.
+        """
+        self._check_open()
+        if self._serve_thread is not None:
+            raise TapystryError("Engine already started")
+        started = threading.Event()
+        begin_error = []
+
+        def serve():
+            # claim the engine before start returns, so that calls right after start are routed to this thread
+            try:
+                self._begin()
+            except BaseException as e:
+                begin_error.append(e)
+                return
+            finally:
+                started.set()
+            self._serve_until_closed()
+
+        self._serve_thread = threading.Thread(target=serve, name="tapystry-engine", daemon=True)
+        self._serve_thread.start()
+        started.wait()
+        if begin_error:
+            self._serve_thread.join()
+            self._serve_thread = None
+            raise begin_error[0]
+        return self
+
+    def _serve(self):
+        q = self._q
+        inbox = self._inbox
+        countdown = _BUSY_CHECK_INTERVAL
+        while not self._stopping:
+            strand = None
+            try:
+                if inbox:
+                    self._drain_inbox()
+
+                if len(q):
+                    strand = q.pop()
+                    self.handle(strand, strand._effect)
+                    countdown -= 1
+                    if not countdown:
+                        countdown = _BUSY_CHECK_INTERVAL
+                        strand = None
+                        self._while_busy()
+                    continue
+
+                if self._external_broadcasts:
+                    self._deliver_external_broadcast()
+                    continue
+                if self._active_timers:
+                    self._fire_timers()
+                if q or inbox:
+                    continue
+
+                self._wakeup.clear()
+                self._sleeping = True
+                if not (inbox or self._external_broadcasts or self._stopping):
+                    self._wakeup.wait(self._wait_timeout())
+                self._sleeping = False
+            except Exception as e:
+                self._fail(getattr(e, "strand", None) or strand, e)
+
+    def _fail(self, strand, exc):
+        """
+        Fails the root strand that strand belongs to, canceling it
+        """
+        if strand is None:
+            # can't tell where this came from, so give up on everything
+            roots = list(self._roots)
         else:
-            raise TapystryError(f"Unhandled effect type {type(effect)}: {strand.stack()}")
+            root = strand
+            while root._parent is not None:
+                root = root._parent
+            roots = [root]
+        for root in roots:
+            self._cancel_strand(root)
+            future = self._roots.pop(root, None)
+            if future is not None and not future.done():
+                future.set_exception(exc)
+
+    async def run_async(self, gen, args=(), kwargs=None, caller=None):
+        """
+        Like run, but interleaved with the running asyncio event loop, which is also used for Await effects
+        """
+        self._begin()
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        wakeup = asyncio.Event()
+        self._notify = lambda: loop.call_soon_threadsafe(wakeup.set)
+        try:
+            if caller is None:
+                caller = get_nth_frame(1)
+            root = self.spawn(caller, gen, args, kwargs, parent=None)
+            future = Future()
+            future.set_running_or_notify_cancel()
+            if root.is_done():
+                # wasn't even a generator
+                future.set_result(root.get_result())
+            else:
+                self._add_root(root, future)
+                self.advance(root)
+            await self._run_until_idle_async(wakeup)
+            self._check_hanging()
+            assert future.done()
+            return future.result()
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._loop = None
+            self._notify = self._wakeup.set
+            self._end()
+
+    async def _run_until_idle_async(self, wakeup):
+        q = self._q
+        inbox = self._inbox
+        while True:
+            handled = 0
+            while inbox or q:
+                if inbox:
+                    self._drain_inbox()
+                if q:
+                    strand = q.pop()
+                    self.handle(strand, strand._effect)
+                handled += 1
+                if handled % _BUSY_CHECK_INTERVAL == 0:
+                    self._while_busy()
+                if handled % _ASYNC_BATCH_SIZE == 0:
+                    # let other tasks on the asyncio loop run
+                    await self._yield_to_loop()
+
+            if self._external_broadcasts:
+                self._deliver_external_broadcast()
+                continue
+            if self._active_timers:
+                self._fire_timers()
+            if self._is_idle():
+                break
+            if q:
+                continue
+
+            wakeup.clear()
+            self._sleeping = True
+            if not (inbox or self._external_broadcasts):
+                try:
+                    await self._yield_to_loop(asyncio.wait_for(wakeup.wait(), self._wait_timeout()))
+                except asyncio.TimeoutError:
+                    pass
+            self._sleeping = False
+
+    async def _yield_to_loop(self, awaitable=None):
+        try:
+            if awaitable is None:
+                await asyncio.sleep(0)
+            else:
+                await awaitable
+        finally:
+            # other tasks on the loop (e.g. other engines) may have changed the capture mode
+            _capture_settings.mode = self.capture_callers
+
+    def _check_hanging(self):
+        for strand in self._hanging_strands:
+            if not strand.is_canceled():
+                assert not (strand._parent and strand._parent.is_canceled())
+                # TODO: add notes on how this can happen
+                # forgetting to join fork or forgot to cancel subscription?
+                # joining thread that never ends
+                # receiving message that never gets broadcast
+                raise TapystryError(f"Hanging strands detected waiting for {strand._effect}, in {strand.stack()}")
+        assert not self._roots
+
+    def _abort(self):
+        """
+        Cancels everything after an error, so the engine can be used again
+        """
+        roots = self._roots
+        self._roots = dict()
+        for root, future in roots.items():
+            self._cancel_strand(root)
+            if not future.done():
+                future.set_exception(TapystryError(f"Engine stopped before strand finished: {root}"))
+        self._q.clear()
+        self._hanging_strands.clear()
+        self._waiting.clear()
+        self._receive_timers.clear()
+        self._done_waiting.clear()
+        self._intercepts.clear()
+        self._external_broadcasts.clear()
+        # their strands were canceled, so don't wait for them to finish
+        self._pending_external.clear()
+        for timer in self._timers:
+            timer.callback = None
+        self._timers = []
+        for timer in self._idle_timers:
+            timer.callback = None
+        self._idle_timers.clear()
+        self._active_timers = 0
+
+    def close(self):
+        """
+        Stops serving, if the engine was started, and shuts down the engine's thread and process pools.
+        Work already running in them is not interrupted, but its results are dropped.
+        Root strands which haven't finished have their futures failed.
+        """
+        if self._closed:
+            return
+        self._stopping = True
+        self._notify()
+        if self._serve_thread is not None and self._serve_thread is not threading.current_thread():
+            self._serve_thread.join()
+        self._closed = True
+        # fail submissions that never got to start
+        while self._inbox:
+            fn = self._inbox.popleft()
+            if isinstance(fn, partial) and fn.func == self._start_root:
+                future = fn.args[-1]
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(TapystryError("Engine closed before strand started"))
+            elif isinstance(fn, partial) and fn.func == self._run_from_thread:
+                fn.args[-1].cancel()
+        for pool in self._pools.values():
+            pool.executor.shutdown(wait=False)
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=False)
+            self._process_executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# number of effects run_async handles before yielding to other asyncio tasks
+_ASYNC_BATCH_SIZE = 1000
+# number of effects handled between checks for due timers, while the queue is busy
+_BUSY_CHECK_INTERVAL = 64
+
+
+@register_handler(Broadcast)
+def _handle_broadcast(engine, strand, effect):
+    engine._broadcast(effect.key, effect.value)
+    engine.advance(strand)
+
+
+@register_handler(Receive)
+def _handle_receive(engine, strand, effect):
+    engine._add_receiving_strand(strand, effect)
+
+
+@register_handler(Call)
+def _handle_call(engine, strand, effect):
+    kwargs = effect.kwargs
+    it = effect.gen(*effect.args, **kwargs) if kwargs else effect.gen(*effect.args)
+    if not isinstance(it, types.GeneratorType):
+        # wasn't even a generator, so there's nothing to run in a strand
+        engine.advance(strand, it)
+        return
+    if engine.inline_calls:
+        strand._call_inline(it, effect)
+        engine.advance(strand)
+        return
+    # run the generator up to its first effect before creating a strand for it,
+    # since helpers often return without yielding anything
+    try:
+        call_effect = it.send(None)
+    except StopIteration as e:
+        engine.advance(strand, e.value)
+        return
+    except Exception as e:
+        call_strand = Strand._started(
+            effect._caller, it, None, parent=strand, edge=effect.name or "call", id=next(engine._strand_ids)
+        )
+        raise call_strand._error(e)
+    call_strand = Strand._started(
+        effect._caller, it, call_effect, parent=strand, edge=effect.name or "call", id=next(engine._strand_ids)
+    )
+    engine._add_joining_strand(strand, call_strand)
+    engine._queue_effect(call_effect, call_strand)
+
+
+@register_handler(CallFork)
+def _handle_call_fork(engine, strand, effect):
+    fork_strand = engine.spawn(effect._caller, effect.gen, effect.args, effect.kwargs, parent=strand, edge=effect.name or "fork")
+    if not effect.run_first:
+        engine.advance(strand, fork_strand)
+    if not fork_strand.is_done():
+        # otherwise wasn't even a generator
+        engine.advance(fork_strand)
+    if effect.run_first:
+        engine.advance(strand, fork_strand)
+
+
+def _yield_for_thread(context, effect, future):
+    try:
+        result = yield effect
+    except Exception as e:
+        context._pending.discard(future)
+        future.set_exception(e)
+    else:
+        context._pending.discard(future)
+        future.set_result(result)
+
+
+@register_handler(CallThread)
+def _handle_call_thread(engine, strand, effect):
+    engine._handle_call_thread(effect, strand)
+
+
+@register_handler(CallProcess)
+def _handle_call_process(engine, strand, effect):
+    engine._handle_call_process(effect, strand)
+
+
+@register_handler(Await)
+def _handle_await(engine, strand, effect):
+    if engine._loop is None:
+        if inspect.iscoroutine(effect.awaitable):
+            # avoid a "never awaited" warning on top of the error
+            effect.awaitable.close()
+        raise _strand_error(strand, f"Await can only be used in strands started with run_async: {strand.stack()}")
+    future = asyncio.ensure_future(effect.awaitable, loop=engine._loop)
+    engine._hanging_strands[strand] = future.cancel
+    engine._wait_external(strand, future)
+
+
+@register_handler(First)
+def _handle_first(engine, strand, effect):
+    engine._add_racing_strand(effect.strands, strand, effect.cancel_losers, effect.ensure_cancel)
+
+
+@register_handler(ForkMany)
+def _handle_fork_many(engine, strand, effect):
+    fork_strands = []
+    for fork_effect in effect.effects:
+        # the strands start out waiting on their effect, rather than taking a step to get to it
+        it = _yield_effect(fork_effect)
+        next(it)
+        fork_strands.append(Strand._started(
+            effect._caller, it, fork_effect, parent=strand, edge="fork", id=next(engine._strand_ids)
+        ))
+    if not effect.run_first:
+        engine.advance(strand, fork_strands)
+    # queue the effects so that they are handled in order, like those of separate CallForks would be
+    for fork_strand in fork_strands:
+        if not fork_strand._effect.immediate:
+            engine._queue_effect(fork_strand._effect, fork_strand)
+    for fork_strand in reversed(fork_strands):
+        if fork_strand._effect.immediate:
+            engine._queue_effect(fork_strand._effect, fork_strand)
+    if effect.run_first:
+        engine.advance(strand, fork_strands)
+
+
+@register_handler(Race)
+def _handle_race(engine, strand, effect):
+    race = _Race(engine, strand, effect.keys)
+    engine._hanging_strands[strand] = None
+    done_waiting = engine._done_waiting
+    branches = race.branches
+    for i, branch_effect in enumerate(effect.effects):
+        it = _yield_effect(branch_effect)
+        next(it)
+        branch = Strand._started(effect._caller, it, branch_effect, parent=strand, edge="race", id=next(engine._strand_ids))
+        branches.append(branch)
+        done_waiting[branch][partial(race.receive, i)] = None
+    # queue the effects like ForkMany does, so that the first listed branch wins ties
+    for branch in branches:
+        if not branch._effect.immediate:
+            engine._queue_effect(branch._effect, branch)
+    for branch in reversed(branches):
+        if branch._effect.immediate:
+            engine._queue_effect(branch._effect, branch)
+
+
+@register_handler(JoinAll)
+def _handle_join_all(engine, strand, effect):
+    engine._add_joining_all(strand, effect.strands)
+
+
+@register_handler(Cancel)
+def _handle_cancel(engine, strand, effect):
+    engine._cancel_strand(effect.strand)
+    engine.advance(strand)
+
+
+@register_handler(Intercept)
+def _handle_intercept(engine, strand, effect):
+    if not engine.test_mode:
+        raise _strand_error(strand, f"Cannot intercept outside of test mode!")
+    engine._intercepts.append((strand, effect))
+    engine._hanging_strands[strand] = None
+
+
+def _wake_sleeping_strand(engine, strand):
+    engine._hanging_strands.pop(strand, None)
+    engine.advance(strand)
+
+
+@register_handler(Sleep)
+def _handle_sleep(engine, strand, effect):
+    timer = engine.call_later(effect.seconds, partial(_wake_sleeping_strand, engine, strand))
+    engine._hanging_strands[strand] = timer.cancel
+
+
+def _yield_effect(effect):
+    val = yield effect
+    return val
+
+
+@register_handler(Timeout)
+def _handle_timeout(engine, strand, effect):
+    if isinstance(effect.effect, Receive):
+        # receives can time out without a helper strand
+        engine._add_receiving_strand(strand, effect.effect, timeout=effect.seconds)
+        return
+
+    effect_strand = engine.spawn(effect._caller, _yield_effect, (effect.effect,), parent=strand, edge=effect.name)
+
+    def timed_out():
+        engine._cancel_strand(effect_strand)
+        engine._hanging_strands.pop(strand, None)
+        engine.throw(strand, TimeoutError(f"{effect.effect} timed out after {effect.seconds} seconds"))
+
+    timer = engine.call_later(effect.seconds, timed_out)
+
+    def finished(val):
+        timer.cancel()
+        engine._hanging_strands.pop(strand, None)
+        engine.advance(strand, val)
+
+    engine._hanging_strands[strand] = timer.cancel
+    engine._done_waiting[effect_strand][finished] = None
+    engine.advance(effect_strand)
+
+
+@register_handler(DebugTree)
+def _handle_debug_tree(engine, strand, effect):
+    root = strand
+    while root._parent is not None:
+        root = root._parent
+    engine.advance(strand, root.tree())
 
-    advance_strand(initial_strand)
-    while True:
-        if not (len(q) or len(thread_strands)):
-            break
 
-        while thread_strands:
-            try:
-                result, id = threads_q.get(block=len(q) == 0)
-                strand = thread_strands[id]
-                if not strand.is_canceled():
-                    advance_strand(strand, value=result)
-                del thread_strands[id]
-            except queue.Empty:
-                break
+@register_handler(Wrapper)
+def _handle_wrapper(engine, strand, effect):
+    engine.handle(strand, effect.effect)
+
 
-        if len(q):
-            item = q.pop()
-            handle_item(item.strand, item.effect)
-
-    for strand in hanging_strands:
-        if not strand.is_canceled():
-            assert not (strand._parent and strand._parent.is_canceled())
-            # TODO: add notes on how this can happen
-            # forgetting to join fork or forgot to cancel subscription?
-            # joining thread that never ends
-            # receiving message that never gets broadcast
-            raise TapystryError(f"Hanging strands detected waiting for {strand._effect}, in {strand.stack()}")
-
-    assert initial_strand.is_done()
-    return initial_strand.get_result()
+def run(
+    gen, args=(), kwargs=None, debug=False, test_mode=False, max_threads=None, max_processes=None,
+    capture_callers="lazy", pools=None, inline_calls=False,
+):
+    """
+    Run the generator gen as the root strand in a new Engine, and return its result.
+    See Engine for the meaning of the other arguments.
+    """
+    with Engine(
+        debug=debug, test_mode=test_mode, max_threads=max_threads, max_processes=max_processes, pools=pools,
+        capture_callers=capture_callers, inline_calls=inline_calls,
+    ) as engine:
+        return engine.run(gen, args, kwargs, caller=get_nth_frame(1))
+
+
+async def run_async(
+    gen, args=(), kwargs=None, debug=False, test_mode=False, max_threads=None, max_processes=None,
+    capture_callers="lazy", pools=None, inline_calls=False,
+):
+    """
+    Like run, but runs the strands as part of the running asyncio event loop,
+    periodically yielding to other tasks on it, and never blocking it.
+    Strands can use Await to await coroutines and other awaitables without a thread.
+    """
+    with Engine(
+        debug=debug, test_mode=test_mode, max_threads=max_threads, max_processes=max_processes, pools=pools,
+        capture_callers=capture_callers, inline_calls=inline_calls,
+    ) as engine:
+        return await engine.run_async(gen, args, kwargs, caller=get_nth_frame(1))
@@ -0,0 +1,106 @@
+import asyncio
+import time
+import pytest
+
+import tapystry as tap
+
+
+def test_run_async():
+    async def fetch(x):
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    def receiver():
+        value = yield tap.Receive('key')
+        return value
+
+    def fn():
+        recv_strand = yield tap.CallFork(receiver)
+        a = yield tap.Await(fetch(1))
+        yield tap.Broadcast('key', a)
+        b = yield tap.Join(recv_strand)
+        c = yield tap.CallThread(lambda: 5)
+        yield tap.Sleep(0.01)
+        return a + b + c
+
+    assert asyncio.run(tap.run_async(fn)) == 9
+
+
+def test_run_async_concurrent_with_loop():
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.001)
+            ticks += 1
+
+    def fn():
+        strands = []
+        for i in range(10):
+            strands.append((yield tap.Fork(tap.Await(asyncio.sleep(0.02, result=i)))))
+        return (yield tap.Join(strands))
+
+    async def main():
+        task = asyncio.ensure_future(ticker())
+        t = time.time()
+        results = await tap.run_async(fn)
+        # awaits ran concurrently
+        assert time.time() - t < 0.1
+        task.cancel()
+        return results
+
+    assert asyncio.run(main()) == list(range(10))
+    assert ticks > 0
+
+
+def test_await_exception():
+    async def fail():
+        raise KeyError("missing")
+
+    def fn():
+        try:
+            yield tap.Await(fail())
+        except KeyError:
+            return "caught"
+
+    assert asyncio.run(tap.run_async(fn)) == "caught"
+
+
+def test_await_cancel():
+    canceled = False
+
+    async def forever():
+        nonlocal canceled
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            canceled = True
+            raise
+
+    def fn():
+        winner, _ = yield tap.Race(dict(
+            slow=tap.Await(forever()),
+            fast=tap.Sleep(0.01),
+        ))
+        return winner
+
+    async def main():
+        result = await tap.run_async(fn)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == "fast"
+    assert canceled
+
+
+def test_await_requires_async():
+    async def noop():
+        pass
+
+    def fn():
+        yield tap.Await(noop())
+
+    with pytest.raises(tap.TapystryError) as x:
+        tap.run(fn)
+    assert str(x.value).startswith("Await can only be used")
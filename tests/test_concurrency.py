@@ -1,4 +1,9 @@
+import gc
+import os
 import threading
+import time
+import tracemalloc
+from concurrent.futures import CancelledError
 import pytest
 
 import tapystry as tap
@@ -450,6 +455,188 @@ def test_race_threads():
     tap.run(fn)
 
 
+def test_thread_exception():
+    def thread_fn():
+        raise ValueError("bad")
+
+    def fn():
+        try:
+            yield tap.CallThread(thread_fn)
+        except ValueError as e:
+            return str(e)
+
+    assert tap.run(fn) == "bad"
+
+
+def test_thread_burst():
+    # many threads finishing while the loop is busy or about to sleep should all wake it up
+    def fn():
+        strands = []
+        for i in range(2000):
+            strands.append((yield tap.Fork(tap.CallThread(abs, (-i,)))))
+        return (yield tap.Join(strands))
+
+    assert tap.run(fn, max_threads=16) == list(range(2000))
+
+
+def test_call_process():
+    def fn():
+        strands = []
+        for i in range(4):
+            strands.append((yield tap.Fork(tap.CallProcess(pow, (2, i)))))
+        results = yield tap.Join(strands)
+        try:
+            yield tap.CallProcess(int, ("not a number",))
+        except ValueError:
+            return results
+
+    assert tap.run(fn, max_processes=2) == [1, 2, 4, 8]
+
+
+def test_cancel_queued_process():
+    def fn():
+        running = yield tap.Fork(tap.CallProcess(time.sleep, (0.2,)))
+        # the pool hands a couple of calls to its workers ahead of time, after which they can't be canceled
+        ahead = yield tap.Fork([tap.CallProcess(time.sleep, (0,)) for _ in range(3)])
+        queued = yield tap.Fork(tap.CallProcess(time.sleep, (10,)))
+        yield tap.Cancel(queued)
+        yield tap.Join([running, ahead])
+
+    t = time.time()
+    tap.run(fn, max_processes=1)
+    # the queued call never ran
+    assert time.time() - t < 5
+
+
+def test_race_thread_cancel_context():
+    stopped = threading.Event()
+
+    def slow(context):
+        while not context.is_canceled():
+            time.sleep(0.001)
+        stopped.set()
+
+    def fn():
+        winner, _ = yield tap.Race([
+            tap.CallThread(slow, pass_context=True),
+            tap.Sleep(0.01),
+        ])
+        assert winner == 1
+        # the loser was told to stop, freeing up the pool for this one
+        yield tap.CallThread(stopped.wait, (5,))
+        assert stopped.is_set()
+
+    t = time.time()
+    tap.run(fn, max_threads=1)
+    assert time.time() - t < 5
+
+
+def test_cancel_queued_thread():
+    ran = []
+
+    def fn():
+        running = yield tap.Fork(tap.CallThread(time.sleep, (0.05,)))
+        queued = yield tap.Fork(tap.CallThread(ran.append, (1,)))
+        yield tap.Cancel(queued)
+        yield tap.Join(running)
+
+    tap.run(fn, max_threads=1)
+    assert ran == []
+
+
+def test_named_pools():
+    started = threading.Event()
+    release = threading.Event()
+
+    def query():
+        started.set()
+        release.wait(5)
+
+    def fn():
+        engine, _ = yield _GetEngine()
+        slow = []
+        for _ in range(3):
+            slow.append((yield tap.Fork(tap.CallThread(query, pool="db"))))
+        # the db pool being busy doesn't hold up the cache pool
+        assert (yield tap.CallThread(started.wait, (5,), pool="cache"))
+        stats = engine.pool_stats()
+        assert stats["db"] == dict(max_workers=1, queued=2, running=1, completed=0)
+        assert stats["cache"]["completed"] == 1
+        release.set()
+        yield tap.Join(slow)
+        assert engine.pool_stats()["db"]["completed"] == 3
+
+    t = time.time()
+    tap.run(fn, pools=dict(db=1, cache=4))
+    assert time.time() - t < 5
+
+
+def test_unknown_pool():
+    def fn():
+        yield tap.CallThread(abs, (-1,), pool="db")
+
+    with pytest.raises(tap.TapystryError) as x:
+        tap.run(fn)
+    assert "No thread pool named 'db'" in str(x.value)
+
+
+def test_thread_yields_effects():
+    lock = tap.Lock()
+    progress = []
+
+    def worker(n, context):
+        release = context.run(lock.Acquire())
+        for i in range(n):
+            context.run(tap.Broadcast("progress", i))
+        context.run(release)
+        try:
+            context.run(tap.Receive("never", timeout=0.01))
+        except TimeoutError:
+            return n
+
+    def on_progress(i):
+        progress.append(i)
+        if False:
+            yield
+
+    def fn():
+        subscription = yield tap.Subscribe("progress", on_progress)
+        release = yield lock.Acquire()
+        t = yield tap.Fork(tap.CallThread(worker, (3,), pass_context=True))
+        yield tap.Sleep(0.01)
+        # still waiting on the lock
+        assert progress == []
+        yield release
+        assert (yield tap.Join(t)) == 3
+        assert progress == [0, 1, 2]
+        yield tap.Cancel(subscription)
+
+    tap.run(fn)
+
+
+def test_thread_yield_canceled():
+    outcome = []
+
+    def worker(context):
+        try:
+            context.run(tap.Receive("never"))
+        except CancelledError:
+            outcome.append("canceled")
+        # further effects are refused too
+        try:
+            context.run(tap.Broadcast("x"))
+        except CancelledError:
+            outcome.append("refused")
+
+    def fn():
+        t = yield tap.Fork(tap.CallThread(worker, pass_context=True))
+        yield tap.Sleep(0.01)
+        yield tap.Cancel(t)
+
+    tap.run(fn)
+    assert outcome == ["canceled", "refused"]
+
+
 def test_immediate_thread():
     def fn():
         def fast():
@@ -457,3 +644,93 @@ def test_immediate_thread():
         yield tap.Race([tap.CallThread(fast)])
 
     tap.run(fn)
+
+
+class _GetEngine(tap.Effect):
+    def __init__(self):
+        super().__init__(type="GetEngine")
+
+
+@tap.register_handler(_GetEngine)
+def _handle_get_engine(engine, strand, effect):
+    engine.advance(strand, (engine, strand))
+
+
+def test_lock_cycles_constant_memory():
+    # set TAPYSTRY_LOCK_CYCLES=1000000 for the full regression run
+    cycles = int(os.environ.get("TAPYSTRY_LOCK_CYCLES", 10000))
+    lock = tap.Lock()
+    memory = []
+
+    def worker(n, measure):
+        for i in range(n):
+            release = yield lock.Acquire()
+            # lets the other worker queue up on the lock
+            yield tap.Broadcast("tick")
+            yield release
+            if measure and i % (n // 5) == 0:
+                gc.collect()
+                memory.append(tracemalloc.get_traced_memory()[0])
+
+    def canceled_waiter():
+        release = yield lock.Acquire()
+        yield release
+
+    def fn():
+        engine, root = yield _GetEngine()
+        # strands canceled while waiting on the lock shouldn't leave anything behind either
+        release = yield lock.Acquire()
+        for _ in range(100):
+            t = yield tap.CallFork(canceled_waiter)
+            yield tap.Sleep(0)
+            yield tap.Cancel(t)
+        yield release
+
+        a = yield tap.CallFork(worker, (cycles // 2, True))
+        b = yield tap.CallFork(worker, (cycles // 2, False))
+        yield tap.Join([a, b])
+        return engine, root
+
+    tracemalloc.start()
+    try:
+        engine, root = tap.run(fn)
+    finally:
+        tracemalloc.stop()
+
+    assert len(memory) == 5
+    # allow for some noise, but nothing proportional to the number of cycles
+    assert memory[-1] - memory[1] < 50000, memory
+    assert not engine._waiting
+    assert not engine._done_waiting
+    assert not engine._hanging_strands
+    assert not engine._roots
+    assert not root._live_children
+
+
+def test_canceled_joins_release_waiters():
+    def waiter():
+        return (yield tap.Receive("stop"))
+
+    def fn():
+        engine, _ = yield _GetEngine()
+        w = yield tap.CallFork(waiter)
+        for _ in range(1000):
+            with pytest.raises(TimeoutError):
+                yield tap.Timeout(tap.Join(w), 0)
+            assert (yield tap.Race([tap.Join(w), tap.Sleep(0)]))[0] == 1
+            assert (yield tap.Race([tap.Join([w, w]), tap.Sleep(0)]))[0] == 1
+            # the loser isn't canceled, but can't resume the First anymore
+            other = yield tap.Fork(tap.Receive("other"))
+            first = yield tap.Fork(tap.First([w, other], cancel_losers=False))
+            yield tap.Sleep(0)
+            yield tap.Broadcast("other", 1)
+            assert (yield tap.Join(first)) == (1, 1)
+        # joins that gave up don't leave anything behind on the strand they were waiting for
+        assert len(engine._done_waiting.get(w, ())) == 0
+        yield tap.Broadcast("stop", "done")
+        assert (yield tap.Join(w)) == "done"
+        return engine
+
+    engine = tap.run(fn)
+    assert not engine._done_waiting
+    assert not engine._hanging_strands
@@ -37,6 +37,35 @@ def test_join_dict():
     )
 
 
+def test_join_many():
+    def ret(value):
+        if value % 2:
+            yield tap.Receive('go')
+        return value
+
+    def fn():
+        strands = []
+        for i in range(1000):
+            strands.append((yield tap.CallFork(ret, (i,))))
+        # some are done already, the rest are waiting
+        joined = yield tap.Fork(tap.Join(dict(evens=strands[::2], odds=strands[1::2], empty=[])))
+        yield tap.Broadcast('go')
+        return (yield tap.Join(joined))
+
+    assert tap.run(fn) == dict(evens=list(range(0, 1000, 2)), odds=list(range(1, 1000, 2)), empty=[])
+
+
+def test_join_all_canceled():
+    def fn():
+        t = yield tap.Fork(tap.Receive('go'))
+        joiner = yield tap.Fork(tap.JoinAll([t]))
+        yield tap.Cancel(joiner)
+        yield tap.Broadcast('go')
+        assert (yield tap.JoinAll([t])) == [None]
+
+    tap.run(fn)
+
+
 def test_fork():
     def ret(value):
         yield tap.Broadcast('key', value)
@@ -53,6 +82,119 @@ def test_fork():
     assert tap.run(fn) == [5, 6]
 
 
+def test_fork_many():
+    started = []
+
+    def ret(value):
+        started.append(value)
+        yield tap.Broadcast('key', value)
+        return value
+
+    def fn():
+        t = yield tap.Fork(dict(
+            a=tap.Call(ret, (0,)),
+            bs=[tap.Call(ret, (1,)), [tap.Call(ret, (2,))]],
+            c=tap.Receive('key'),
+        ))
+        assert set(t.keys()) == {"a", "bs", "c"}
+        results = yield tap.Join(t)
+        # started in the order they were given
+        assert started == [0, 1, 2]
+        return results
+
+    assert tap.run(fn) == dict(a=0, bs=[1, [2]], c=0)
+
+
+def test_fork_many_run_first():
+    def fn():
+        strands = yield tap.ForkMany([tap.Receive('key'), tap.Broadcast('key', 5)], run_first=True)
+        assert (yield tap.Join(strands)) == [5, None]
+        with pytest.raises(tap.TapystryError):
+            tap.ForkMany([tap.Receive('key'), None])
+
+    tap.run(fn)
+
+
+def test_map():
+    in_flight = 0
+    max_in_flight = 0
+
+    def work(i):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        # some calls take longer than others
+        yield tap.Sleep(0.001 * (i % 5 == 0))
+        in_flight -= 1
+        return i * 2
+
+    def fn():
+        results = yield tap.Map(work, iter(range(100)), concurrency=8)
+        assert results == [i * 2 for i in range(100)]
+        assert max_in_flight == 8
+        assert (yield tap.Map(abs, [-1, -2, 3])) == [1, 2, 3]
+        assert (yield tap.Map(abs, [])) == []
+
+    tap.run(fn)
+
+
+def test_map_lazy_and_unordered():
+    taken = []
+
+    def items():
+        for i in range(10):
+            taken.append(i)
+            yield i
+
+    def work(i):
+        yield tap.Receive('go', match=dict(item=i))
+        return i
+
+    def fn():
+        t = yield tap.Fork(tap.Map(work, items(), concurrency=2, ordered=False))
+        yield tap.Sleep(0)
+        # only taken from the iterator as calls start
+        assert taken == [0, 1]
+        for i in [1, 0, 3, 2, 5, 4, 7, 6, 9, 8]:
+            yield tap.Broadcast('go', dict(item=i))
+            yield tap.Sleep(0)
+        assert (yield tap.Join(t)) == [1, 0, 3, 2, 5, 4, 7, 6, 9, 8]
+
+    tap.run(fn)
+
+
+def test_map_streaming():
+    def work(i):
+        yield tap.Receive('go', match=dict(item=i))
+        return i * 2
+
+    def fn():
+        for ordered in (True, False):
+            streamed = []
+
+            def on_result(item, result):
+                streamed.append((item, result))
+                # streaming callbacks can take effects too
+                yield tap.Sleep(0)
+
+            t = yield tap.Fork(tap.Map(work, range(6), concurrency=3, ordered=ordered, on_result=on_result))
+            yield tap.Sleep(0)
+            yield tap.Broadcast('go', dict(item=1))
+            yield tap.Sleep(0)
+            # results come out while the Map is still running
+            assert streamed == ([] if ordered else [(1, 2)])
+            for i in [0, 3, 2, 5, 4]:
+                yield tap.Broadcast('go', dict(item=i))
+                yield tap.Sleep(0)
+            assert (yield tap.Join(t)) is None
+            if ordered:
+                assert streamed == [(i, i * 2) for i in range(6)]
+            else:
+                assert streamed == [(i, i * 2) for i in [1, 0, 3, 2, 5, 4]]
+
+    tap.run(fn)
+
+
 def test_race():
     def recv1():
         yield tap.Receive('key1')
@@ -117,6 +259,52 @@ def test_race_dict():
     assert tap.run(fn) == 13
 
 
+def test_race_cancels_losers():
+    canceled = []
+
+    def fn():
+        effects = {i: tap.Receive(f"key.{i}", oncancel=lambda i=i: canceled.append(i)) for i in range(100)}
+        t = yield tap.Fork(tap.Race(effects))
+        yield tap.Broadcast("key.42", "won")
+        assert (yield tap.Join(t)) == (42, "won")
+        assert sorted(canceled) == [i for i in range(100) if i != 42]
+
+    tap.run(fn)
+
+
+def test_race_ties():
+    def a():
+        yield tap.Receive("key")
+        return "a"
+
+    def first():
+        if False:
+            yield
+        return "first"
+
+    def second():
+        if False:
+            yield
+        return "second"
+
+    def fn():
+        t = yield tap.Fork(tap.Race([tap.Call(a), tap.Call(a)]))
+        yield tap.Sleep(0)
+        yield tap.Broadcast("key")
+        # branches resolved in the same step are won by the first listed
+        assert (yield tap.Join(t)) == (0, "a")
+        assert (yield tap.Race([tap.Call(first), tap.Call(second)])) == (0, "first")
+
+    tap.run(fn)
+
+
+def test_race_bad_input():
+    with pytest.raises(tap.TapystryError):
+        tap.Race([tap.Receive("key"), "not an effect"])
+    with pytest.warns(DeprecationWarning):
+        tap.Race([tap.Receive("key")], ensure_cancel=False)
+
+
 def test_nested_cancel():
     a = 0
     b = 0
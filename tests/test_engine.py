@@ -0,0 +1,242 @@
+import threading
+import time
+import pytest
+
+import tapystry as tap
+
+
+def test_engine_reuse():
+    def double(x):
+        yield tap.Broadcast('key', x)
+        value = yield tap.CallThread(lambda: x * 2)
+        return value
+
+    with tap.Engine(max_threads=2) as engine:
+        assert [engine.run(double, (i,)) for i in range(5)] == [0, 2, 4, 6, 8]
+        # the same pool is used throughout
+        assert engine.run(double, (5,)) == 10
+        assert engine.pool_stats()["default"]["completed"] == 6
+
+    with pytest.raises(tap.TapystryError) as x:
+        engine.run(double, (1,))
+    assert str(x.value) == "Engine is closed"
+
+
+def test_engine_submit():
+    def receiver():
+        value = yield tap.Receive('key')
+        return value
+
+    def broadcaster(value):
+        yield tap.Broadcast('key', value)
+        return "sent"
+
+    def plain():
+        return "plain"
+
+    engine = tap.Engine()
+    recv = engine.submit(receiver)
+    send = engine.submit(broadcaster, (5,))
+    not_gen = engine.submit(plain)
+    assert not recv.done()
+    engine.run_until_idle()
+    assert recv.result() == 5
+    assert send.result() == "sent"
+    assert not_gen.result() == "plain"
+    engine.close()
+
+
+def test_engine_after_error():
+    def bad():
+        yield tap.Receive('never')
+
+    def good():
+        yield tap.Broadcast('key')
+        return 3
+
+    with tap.Engine() as engine:
+        other = engine.submit(bad)
+        with pytest.raises(tap.TapystryError) as x:
+            engine.run(bad)
+        assert str(x.value).startswith("Hanging strands")
+        assert isinstance(other.exception(), tap.TapystryError)
+        # everything from the failed run was cleaned up
+        assert engine.run(good) == 3
+
+    release = threading.Event()
+
+    def bad_with_thread():
+        yield tap.Fork(tap.CallThread(release.wait, (5,)))
+        yield tap.Sleep(0)
+        raise ValueError("bad")
+
+    with tap.Engine() as engine:
+        with pytest.raises(tap.TapystryError):
+            engine.run(bad_with_thread)
+        # the next run doesn't wait for threads of strands the failed run canceled
+        t = time.time()
+        assert engine.run(good) == 3
+        assert time.time() - t < 1
+        release.set()
+
+
+def test_engine_not_reentrant():
+    engine = tap.Engine()
+
+    def inner():
+        yield tap.Broadcast('key')
+
+    def outer():
+        engine.run(inner)
+        yield tap.Broadcast('key')
+
+    with pytest.raises(tap.TapystryError) as x:
+        engine.run(outer)
+    assert "Engine is already running" in str(x.value)
+    engine.close()
+
+
+def test_engine_serve():
+    def job(i):
+        yield tap.Sleep(0.001)
+        result = yield tap.CallThread(lambda: i * i)
+        return result
+
+    def failing():
+        yield tap.Sleep(0.001)
+        raise ValueError("bad job")
+
+    engine = tap.Engine().start()
+    futures = []
+
+    def submit_many(start):
+        for i in range(start, start + 50):
+            futures.append((i, engine.submit(job, (i,))))
+
+    threads = [threading.Thread(target=submit_many, args=(i * 50,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    bad = engine.submit(failing)
+    for t in threads:
+        t.join()
+
+    for i, future in futures:
+        assert future.result(timeout=5) == i * i
+    # the failure only affects its own strand
+    with pytest.raises(tap.TapystryError) as x:
+        bad.result(timeout=5)
+    assert "ValueError: bad job" in str(x.value)
+    # run from another thread goes through the serving loop
+    assert engine.run(job, (3,)) == 9
+
+    waiting = engine.submit(lambda: (yield tap.Receive('never')))
+    engine.close()
+    with pytest.raises(tap.TapystryError):
+        waiting.result(timeout=5)
+    with pytest.raises(tap.TapystryError):
+        engine.submit(job, (1,))
+
+
+def test_engine_serve_errors_fail_own_root():
+    def after_sleep():
+        yield tap.Sleep(0.01)
+        yield "not an effect"
+
+    def after_receive():
+        yield tap.Receive("go")
+        yield "not an effect"
+
+    def waiting():
+        return (yield tap.Receive("done"))
+
+    def broadcaster():
+        yield tap.Sleep(0.02)
+        yield tap.Broadcast("go")
+        return "broadcast"
+
+    with tap.Engine().start() as engine:
+        healthy = engine.submit(waiting)
+        bad_sleep = engine.submit(after_sleep)
+        bad_receive = engine.submit(after_receive)
+        sender = engine.submit(broadcaster)
+        for bad in (bad_sleep, bad_receive):
+            with pytest.raises(tap.TapystryError) as x:
+                bad.result(timeout=5)
+            assert "Strand yielded non-effect" in str(x.value)
+        # the strand that resumed the failing one carries on
+        assert sender.result(timeout=5) == "broadcast"
+        assert not healthy.done()
+        engine.broadcast("done", "ok")
+        assert healthy.result(timeout=5) == "ok"
+
+
+def test_engine_run_right_after_start():
+    def where():
+        if False:
+            yield
+        return threading.current_thread()
+
+    for _ in range(20):
+        engine = tap.Engine().start()
+        # start only returns once the serving thread has claimed the engine
+        assert engine.run(where) is engine._serve_thread
+        engine.close()
+
+    engine = tap.Engine()
+    engine._running = True
+    with pytest.raises(tap.TapystryError) as x:
+        engine.start()
+    assert "Engine is already running" in str(x.value)
+    assert engine._serve_thread is None
+
+
+def test_engine_external_broadcast():
+    received = []
+
+    def on_message(msg):
+        received.append(msg)
+        if False:
+            yield
+
+    def collect(n):
+        values = []
+        for _ in range(n):
+            values.append((yield tap.Receive('msg', match={"to": "collector"})))
+        return [v["n"] for v in values]
+
+    with tap.Engine().start() as engine:
+        sub = engine.submit(lambda: (yield tap.Subscribe('msg', on_message)))
+        collector = engine.submit(collect, (10,))
+        # like in-engine broadcasts, messages sent before anyone receives are dropped,
+        # so wait for the engine to settle (timers fire once everything else has been handled)
+        engine.run(lambda: (yield tap.Sleep(0)))
+
+        def reader(offset):
+            for i in range(5):
+                engine.broadcast('msg', dict(to="collector", n=offset + i))
+
+        threads = [threading.Thread(target=reader, args=(i * 5,)) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(collector.result(timeout=5)) == list(range(10))
+        engine.run(lambda: (yield tap.Sleep(0)))
+        assert len(received) == 10
+
+
+def test_engine_external_broadcast_while_busy():
+    def busy():
+        while True:
+            yield tap.Broadcast("x")
+
+    def fn():
+        yield tap.CallFork(busy)
+        return (yield tap.Receive("ext"))
+
+    with tap.Engine().start() as engine:
+        future = engine.submit(fn)
+        # the queue never drains, so the message has to be delivered in between
+        engine.run(lambda: (yield tap.Sleep(0.01)))
+        engine.broadcast("ext", 42)
+        assert future.result(timeout=2) == 42
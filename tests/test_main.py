@@ -145,6 +145,69 @@ def test_call_trivial():
     assert tap.run(random, args=(5,)) == 10
 
 
+def test_call_returns_without_yielding():
+    def lookup(key, cache):
+        if key not in cache:
+            yield tap.Broadcast('miss', key)
+            cache[key] = key * 2
+        return cache[key]
+
+    def fn():
+        cache = dict()
+        assert (yield tap.Call(lookup, (1, cache))) == 2
+        assert (yield tap.Call(lookup, (1, cache))) == 2
+        # nothing is left behind for calls which are done
+        tree = yield tap.DebugTree()
+        assert "lookup" not in tree
+        fork = yield tap.CallFork(lookup, (1, cache))
+        assert (yield tap.Join(fork)) == 2
+        fork = yield tap.CallFork(abs, (-1,))
+        assert (yield tap.Join(fork)) == 1
+        tree = yield tap.DebugTree()
+        assert "lookup" not in tree and "abs" not in tree
+
+    tap.run(fn)
+
+
+def test_inline_calls():
+    def inner(x):
+        yield tap.Broadcast('inner', x)
+        return x + 1
+
+    def middle(x):
+        y = yield tap.Call(inner, (x,))
+        return (yield tap.Call(inner, (y,)))
+
+    def fn():
+        t = yield tap.Fork(tap.Receive('never'))
+        x = yield tap.Call(middle, (0,))
+        yield tap.Cancel(t)
+        return x
+
+    assert tap.run(fn, inline_calls=True) == 2
+
+
+def test_inline_calls_error_stack():
+    def inner():
+        yield tap.Broadcast('key')
+        raise ValueError("bad")
+
+    def middle():
+        yield tap.Call(inner)
+
+    def fn():
+        yield tap.Call(middle)
+
+    errors = []
+    for inline_calls in (False, True):
+        with pytest.raises(tap.TapystryError) as x:
+            tap.run(fn, inline_calls=inline_calls)
+        errors.append(str(x.value))
+    assert "in middle\n" in errors[0]
+    # the same as with a strand per call
+    assert errors[0] == errors[1]
+
+
 def test_cancel():
     a = 0
     def add_three(value):
@@ -315,6 +378,153 @@ def test_sleep():
     tap.run(fn)
 
 
+def test_many_sleeps():
+    def sleeper(i):
+        yield tap.Sleep(0.05 - i * 0.00001)
+        return i
+
+    def fn():
+        t = time.time()
+        strands = []
+        for i in range(1000):
+            strands.append((yield tap.CallFork(sleeper, (i,))))
+        results = yield tap.Join(strands)
+        assert results == list(range(1000))
+        assert time.time() - t < 0.5
+
+    # sleeping doesn't use threads
+    tap.run(fn, max_threads=1)
+
+
+def test_sleep_compat():
+    from tapystry.effects import Sleep
+
+    def fn():
+        yield Sleep(0.01, increment=0.005)
+        return "ok"
+
+    assert tap.run(fn) == "ok"
+
+
+def test_sleep_next_to_busy_strand():
+    def busy():
+        while True:
+            yield tap.Broadcast("x")
+
+    def fn():
+        t = yield tap.CallFork(busy)
+        yield tap.Sleep(0.05)
+        yield tap.Cancel(t)
+        return "ok"
+
+    assert tap.run(fn) == "ok"
+
+
+def test_cancel_sleep():
+    def fn():
+        t = time.time()
+        long_sleep = yield tap.Fork(tap.Sleep(10))
+        yield tap.Sleep(0.01)
+        yield tap.Cancel(long_sleep)
+        return time.time() - t
+
+    assert tap.run(fn) < 1
+
+    with pytest.raises(ValueError):
+        tap.Sleep(-1)
+
+
+def test_receive_timeout():
+    def fn():
+        try:
+            yield tap.Receive('key', timeout=0.01)
+        except TimeoutError as e:
+            assert str(e) == "Receive(key) timed out after 0.01 seconds"
+        else:
+            assert False
+
+        t = yield tap.Fork(tap.Receive('key', timeout=10))
+        yield tap.Broadcast('key', 5)
+        assert (yield tap.Join(t)) == 5
+
+        try:
+            yield tap.Timeout(tap.Receive('key'), 0.01)
+        except TimeoutError:
+            pass
+        else:
+            assert False
+        return "ok"
+
+    t = time.time()
+    assert tap.run(fn) == "ok"
+    # the timer for the successful receive was disarmed
+    assert time.time() - t < 1
+
+
+def test_receive_timeout_next_to_busy_strand():
+    def busy():
+        while True:
+            yield tap.Broadcast("x")
+
+    def fn():
+        t = yield tap.CallFork(busy)
+        with pytest.raises(TimeoutError):
+            yield tap.Receive("never", timeout=0.05)
+        with pytest.raises(TimeoutError):
+            yield tap.Timeout(tap.Receive("never"), 0.05)
+        yield tap.Cancel(t)
+        return "ok"
+
+    assert tap.run(fn) == "ok"
+
+
+def test_receive_timeout_oncancel():
+    canceled = []
+
+    def fn():
+        with pytest.raises(TimeoutError):
+            yield tap.Timeout(tap.Receive("key", oncancel=lambda: canceled.append("timeout")), 0.01)
+        with pytest.raises(TimeoutError):
+            yield tap.Receive("key", timeout=0.01, oncancel=lambda: canceled.append("receive timeout"))
+        t = yield tap.Fork(tap.Timeout(tap.Receive("key", oncancel=lambda: canceled.append("cancel")), 10))
+        yield tap.Sleep(0)
+        yield tap.Cancel(t)
+
+    tap.run(fn)
+    assert canceled == ["timeout", "receive timeout", "cancel"]
+
+
+def test_timeout():
+    def slow():
+        yield tap.Sleep(10)
+        return "slow"
+
+    def fast():
+        yield tap.Sleep(0.001)
+        return "fast"
+
+    def fn():
+        assert (yield tap.Timeout(tap.Call(fast), 1)) == "fast"
+        try:
+            yield tap.Timeout(tap.Call(slow), 0.01)
+        except TimeoutError:
+            return "timed out"
+
+    t = time.time()
+    assert tap.run(fn) == "timed out"
+    assert time.time() - t < 1
+
+
+def test_uncaught_timeout():
+    def fn():
+        yield tap.Receive('key', timeout=0)
+
+    with pytest.raises(tap.TapystryError) as x:
+        tap.run(fn)
+    assert str(x.value).startswith("Exception caught at")
+    assert "TimeoutError: Receive(key) timed out" in str(x.value)
+
+
 def test_intercept_nontest():
     def fn():
         yield tap.Intercept()
@@ -472,3 +682,134 @@ def test_another_tricky_cancel():
         assert a < 4, a
 
     tap.run(fn)
+
+
+def test_capture_callers():
+    def receiver():
+        value = yield tap.Receive('key')
+        if value > 0:
+            raise Exception("too large")
+
+    def fn():
+        yield tap.CallFork(receiver)
+        yield tap.Broadcast('key', 1)
+
+    for mode in ["lazy", "full"]:
+        with pytest.raises(tap.TapystryError) as x:
+            tap.run(fn, capture_callers=mode)
+        assert str(x.value).count(", in fn\n") == 1
+        assert "yield tap.CallFork(receiver)" in str(x.value)
+
+    with pytest.raises(tap.TapystryError) as x:
+        tap.run(fn, capture_callers="off")
+    assert "caller not captured" in str(x.value)
+    assert ", in fn\n" not in str(x.value)
+
+    with pytest.raises(ValueError):
+        tap.run(fn, capture_callers="sometimes")
+
+
+def test_register_handler():
+    class Double(tap.Effect):
+        def __init__(self, value, **effect_kwargs):
+            self.value = value
+            super().__init__(type="Double", **effect_kwargs)
+
+    class LoudDouble(Double):
+        pass
+
+    @tap.register_handler(Double)
+    def handle_double(engine, strand, effect):
+        engine.advance(strand, effect.value * 2)
+
+    def fn():
+        x = yield Double(3)
+        y = yield LoudDouble(x)
+        return y
+
+    assert tap.run(fn) == 12
+
+
+def test_unhandled_effect():
+    class Unknown(tap.Effect):
+        def __init__(self):
+            super().__init__(type="Unknown")
+
+    def fn():
+        yield Unknown()
+
+    with pytest.raises(tap.TapystryError) as x:
+        tap.run(fn)
+    assert str(x.value).startswith("Unhandled effect type")
+
+
+def test_strand_ids():
+    def child():
+        yield tap.Broadcast('key')
+
+    def fn():
+        strands = []
+        for _ in range(3):
+            strands.append((yield tap.CallFork(child)))
+        yield tap.Join(strands)
+        return strands
+
+    strands = tap.run(fn)
+    ids = [strand.id for strand in strands]
+    assert all(isinstance(id, int) for id in ids)
+    assert len(set(ids)) == 3
+    assert strands[0].uuid == strands[0].uuid
+    assert strands[0].uuid != strands[1].uuid
+
+
+def test_effect_subclass_attributes():
+    class Tagged(tap.Receive):
+        def __init__(self, key, tag):
+            super().__init__(key)
+            self.tag = tag
+
+    def fn():
+        t = yield tap.Fork(Tagged('key', tag="mine"))
+        yield tap.Broadcast('key', 3)
+        return (yield tap.Join(t))
+
+    assert Tagged('key', tag="mine").tag == "mine"
+    assert tap.run(fn) == 3
+
+
+def test_receive_match():
+    def receiver(id):
+        value = yield tap.Receive('key', match={"id": id})
+        return value["value"]
+
+    def fn():
+        strands = []
+        for i in range(5):
+            strands.append((yield tap.CallFork(receiver, (i,))))
+        odd = yield tap.Fork(tap.Receive('key', lambda v: isinstance(v, dict) and v.get("id", 0) % 2 == 1))
+        yield tap.Broadcast('key', "not a dict")
+        yield tap.Broadcast('key', dict(value="no id"))
+        for i in reversed(range(5)):
+            yield tap.Broadcast('key', dict(id=i, value=i * 10))
+        # the first odd id broadcast was 3
+        assert (yield tap.Join(odd)) == dict(id=3, value=30)
+        return (yield tap.Join(strands))
+
+    assert tap.run(fn) == [0, 10, 20, 30, 40]
+
+
+def test_receive_match_unhashable():
+    with pytest.raises(tap.TapystryError) as x:
+        tap.Receive('key', match={"id": [1]})
+    assert "hashable" in str(x.value)
+
+
+def test_receive_match_and_predicate():
+    def fn():
+        t = yield tap.Fork(tap.Receive('key', lambda v: v["n"] > 1, match={"id": 1, "kind": "a"}))
+        yield tap.Broadcast('key', dict(id=1, kind="b", n=2))
+        yield tap.Broadcast('key', dict(id=1, kind="a", n=1))
+        yield tap.Broadcast('key', dict(id=1, kind="a", n=2))
+        return (yield tap.Join(t))
+
+    assert tap.run(fn) == dict(id=1, kind="a", n=2)